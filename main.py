@@ -1,14 +1,16 @@
 import time
-from collections import defaultdict
 import os
+import json
 
 import tensorflow as tf
 
-from src.input_fn import train_eval_input_fn, predict_input_fn
+from src.input_fn import (train_eval_input_fn, predict_input_fn,
+                          feature_extraction_input_fn, cached_feature_input_fn,
+                          serving_input_fn)
 from src.metrics import ner_evaluate
 from src.model_fn import BertMultiTask
 from src.params import Params
-from src.utils import create_path
+from src.utils import create_path, write_feature_cache, write_label_encoder_json
 from src.estimator import Estimator
 from src.ckpt_restore_hook import RestoreCheckpointHook
 
@@ -28,6 +30,10 @@ flags.DEFINE_integer("gpu", 2,
 flags.DEFINE_string("model_dir", "",
                     "Model dir. If not specified, will use problem_name + _ckpt")
 
+flags.DEFINE_bool("ner_per_type_eval", False,
+                  "After training, predict eval data once more and report "
+                  "entity scores of each type for NER problems")
+
 PROBLEMS_LIST = [
     'WeiboNER',
     'WeiboSegment',
@@ -46,6 +52,9 @@ def main(_):
     if FLAGS.model_dir:
         params.ckpt_dir = FLAGS.model_dir
 
+    if FLAGS.schedule == 'train_cached':
+        params.use_cached_features = True
+
     create_path(params.ckpt_dir)
 
     tf.logging.info('Checkpoint dir: %s' % params.ckpt_dir)
@@ -81,29 +90,112 @@ def main(_):
 
         def input_fn(): return train_eval_input_fn(params, mode='eval')
         estimator.evaluate(input_fn=input_fn)
-        pred = estimator.predict(input_fn=input_fn)
 
-        pred_list = defaultdict(list)
-        for p in pred:
-            for problem in p:
-                pred_list[problem].append(p[problem])
-        for problem in pred_list:
-            if 'NER' in problem:
-                ner_evaluate(problem, pred_list[problem], params)
+        # entity scores are in eval metrics, per type scores
+        # need another pass of eval data
+        ner_problem_list = [
+            problem for problem_dict in params.run_problem_list
+            for problem in problem_dict
+            if 'NER' in problem and params.problem_type[problem] == 'seq_tag']
+        if FLAGS.ner_per_type_eval and ner_problem_list:
+            pred = estimator.predict(input_fn=input_fn)
+            ner_evaluate(ner_problem_list, pred, params)
+
+    elif FLAGS.schedule == 'extract':
+        # run body once and cache features for train_cached
+        extract_estimator = Estimator(
+            model.get_feature_extraction_model_fn(),
+            model_dir=params.ckpt_dir,
+            params=params,
+            config=run_config)
+        checkpoint_path = extract_estimator.latest_checkpoint()
+        if checkpoint_path is None:
+            checkpoint_path = tf.train.latest_checkpoint(
+                params.init_checkpoint)
+
+        for mode in ['train', 'eval']:
+            def input_fn(): return feature_extraction_input_fn(params, mode=mode)
+            pred = extract_estimator.predict(
+                input_fn=input_fn, checkpoint_path=checkpoint_path)
+            cache_dir = os.path.join(params.feature_cache_dir, mode)
+            example_num = write_feature_cache(
+                pred, cache_dir, params.feature_cache_shard_size,
+                params.feature_cache_dtype)
+            tf.logging.info('Write %d examples to %s' %
+                            (example_num, cache_dir))
+
+    elif FLAGS.schedule == 'train_cached':
+        # train tops on features cached by extract
+        def train_input_fn(): return cached_feature_input_fn(params)
+        estimator.train(train_input_fn, max_steps=params.train_steps)
+
+        def input_fn(): return cached_feature_input_fn(params, mode='eval')
+        estimator.evaluate(input_fn=input_fn)
 
     elif FLAGS.schedule == 'eval':
-
-        def input_fn(): return train_eval_input_fn(params, mode='eval')
-        estimator.evaluate(input_fn=input_fn)
-        # pred = estimator.predict(input_fn=input_fn)
-
-        # pred_list = defaultdict(list)
-        # for p in pred:
-        #     for problem in p:
-        #         pred_list[problem].append(p[problem])
-        # for problem in pred_list:
-        #     if 'NER' in problem:
-        #         ner_evaluate(problem, pred_list[problem], params)
+        # evaluate every | separated problem chunk in this process
+        # against the same checkpoint, and write one summary
+        checkpoint_path = estimator.latest_checkpoint()
+        if checkpoint_path is None:
+            raise ValueError('No checkpoint found in %s' % params.ckpt_dir)
+
+        run_problem_list = params.run_problem_list
+        summary = {'checkpoint_path': checkpoint_path, 'problems': {}}
+        for problem_dict in run_problem_list:
+            params.run_problem_list = [problem_dict]
+            chunk_name = '&'.join(problem_dict.keys())
+
+            def input_fn(): return train_eval_input_fn(params, mode='eval')
+            eval_result = estimator.evaluate(
+                input_fn=input_fn, checkpoint_path=checkpoint_path,
+                name=chunk_name)
+            # every chunk is scored against checkpoint_path
+            summary['global_step'] = int(eval_result['global_step'])
+
+            # metric names are prefixed with problem, see create_spec
+            for problem in problem_dict:
+                prefix = '%s_' % problem
+                summary['problems'][problem] = {
+                    k[len(prefix):]: float(v) for k, v in eval_result.items()
+                    if k.startswith(prefix)}
+                summary['problems'][problem]['chunk'] = chunk_name
+                summary['problems'][problem]['checkpoint_path'] = checkpoint_path
+                summary['problems'][problem]['global_step'] = int(
+                    eval_result['global_step'])
+                summary['problems'][problem]['chunk_loss'] = float(
+                    eval_result['loss'])
+        params.run_problem_list = run_problem_list
+
+        tf.logging.info('Eval checkpoint: %s' % checkpoint_path)
+        for problem, metric_dict in summary['problems'].items():
+            tf.logging.info('%s: %s' % (problem, ', '.join(
+                ['%s = %s' % (k, v) for k, v in sorted(metric_dict.items())])))
+        summary_path = os.path.join(params.ckpt_dir, 'eval_summary.json')
+        with open(summary_path, 'w', encoding='utf8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        tf.logging.info('Write eval summary to %s' % summary_path)
+
+    elif FLAGS.schedule == 'export':
+        # export one SavedModel for every | separated problem chunk
+        run_problem_list = params.run_problem_list
+        for problem_dict in run_problem_list:
+            params.run_problem_list = [problem_dict]
+            chunk_name = '&'.join(problem_dict.keys())
+
+            assets_extra = {}
+            for problem, problem_type in problem_dict.items():
+                if problem_type in ['seq_tag', 'cls']:
+                    json_path = write_label_encoder_json(problem)
+                    assets_extra[os.path.basename(json_path)] = json_path
+                    pkl_path = json_path.replace('.json', '.pkl')
+                    assets_extra[os.path.basename(pkl_path)] = pkl_path
+
+            export_dir = estimator.export_saved_model(
+                os.path.join(params.ckpt_dir, 'export', chunk_name),
+                serving_input_fn(params),
+                assets_extra=assets_extra)
+            tf.logging.info('Export %s to %s' % (chunk_name, export_dir))
+        params.run_problem_list = run_problem_list
 
     elif FLAGS.schedule == 'predict':
         def input_fn(): return predict_input_fn(
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import tensorflow as tf
+
+from src.batch_queue import BatchQueue
+from src.estimator_wrapper import get_predictor
+from src.params import Params
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("problem", "NER,CWS",
+                    "Comma separated problems to serve, e.g. NER,CWS,WeiboNER&WeiboSegment")
+
+flags.DEFINE_string("model_dir", "",
+                    "Comma separated model dirs of problems. If not specified, will use problem_name + _ckpt")
+
+flags.DEFINE_integer("gpu", 1,
+                     "number of gpu to use, 0 for cpu")
+
+flags.DEFINE_integer("port", 8000,
+                     "port to listen on localhost")
+
+flags.DEFINE_integer("max_batch_size", 64,
+                     "max number of requests batched into one forward pass")
+
+flags.DEFINE_float("max_wait_ms", 5,
+                   "max time in ms to wait for a batch to fill")
+
+
+class InferenceServer(ThreadingMixIn, HTTPServer):
+    """Serve predictors on localhost
+
+    Every endpoint has its own BatchQueue running on one event loop
+    in a background thread, so concurrent requests from handler
+    threads are batched together.
+
+    Endpoints:
+        POST /<endpoint> {"text": "..."} or {"texts": ["...", ...]}
+            -> {"result": ...} or {"results": [...]}
+        GET /health -> status and endpoints
+        GET /metrics -> latency percentiles, batch sizes and
+            throughput of every endpoint
+    """
+    daemon_threads = True
+
+    def __init__(self, predict_fn_dict, port=8000, max_batch_size=64, max_wait_ms=5):
+        super().__init__(('127.0.0.1', port), RequestHandler)
+        self.start_time = time.time()
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+
+        self.queue_dict = {
+            endpoint: BatchQueue(predict_fn, max_batch_size, max_wait_ms)
+            for endpoint, predict_fn in predict_fn_dict.items()}
+
+    def predict(self, endpoint, texts):
+        """Predict texts through the queue of endpoint, called from
+        handler threads
+        """
+        queue = self.queue_dict[endpoint]
+
+        async def gather():
+            return await asyncio.gather(*[queue.predict(text) for text in texts])
+        return asyncio.run_coroutine_threadsafe(gather(), self.loop).result()
+
+    def metrics(self):
+        uptime = time.time() - self.start_time
+        metrics = {'uptime_s': uptime}
+        for endpoint, queue in self.queue_dict.items():
+            stats = queue.stats()
+            stats['throughput_per_s'] = stats['request_num'] / uptime
+            # json keys must be str
+            stats['batch_size_count'] = {
+                str(k): v for k, v in stats['batch_size_count'].items()}
+            metrics[endpoint] = stats
+        return metrics
+
+    def server_close(self):
+        for queue in self.queue_dict.values():
+            asyncio.run_coroutine_threadsafe(queue.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        super().server_close()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False, default=str).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {
+                'status': 'ok',
+                'endpoints': sorted(self.server.queue_dict.keys())})
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.metrics())
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        endpoint = self.path.strip('/')
+        if endpoint not in self.server.queue_dict:
+            self.send_json(404, {'error': 'Unknown endpoint %s' % endpoint})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf8'))
+        except ValueError as e:
+            self.send_json(400, {'error': 'Invalid json: %s' % e})
+            return
+
+        if 'texts' in request:
+            texts = request['texts']
+        elif 'text' in request:
+            texts = [request['text']]
+        else:
+            self.send_json(400, {'error': 'Either text or texts is required'})
+            return
+
+        try:
+            results = self.server.predict(endpoint, texts)
+        except Exception as e:
+            tf.logging.error('Predict failed: %s' % e)
+            self.send_json(500, {'error': str(e)})
+            return
+
+        if 'texts' in request:
+            self.send_json(200, {'results': results})
+        else:
+            self.send_json(200, {'result': results[0]})
+
+    def log_message(self, format, *args):
+        tf.logging.debug(format % args)
+
+
+def main(_):
+    problem_list = FLAGS.problem.split(',')
+    model_dir_list = FLAGS.model_dir.split(
+        ',') if FLAGS.model_dir else [''] * len(problem_list)
+    if len(model_dir_list) != len(problem_list):
+        raise ValueError('Got %d problems but %d model dirs' %
+                         (len(problem_list), len(model_dir_list)))
+
+    predict_fn_dict = {}
+    for problem, model_dir in zip(problem_list, model_dir_list):
+        _, problem_predict_fn_dict = get_predictor(
+            Params(), problem, model_dir=model_dir if model_dir else None,
+            gpu=FLAGS.gpu)
+        predict_fn_dict.update(problem_predict_fn_dict)
+
+    server = InferenceServer(
+        predict_fn_dict, port=FLAGS.port,
+        max_batch_size=FLAGS.max_batch_size, max_wait_ms=FLAGS.max_wait_ms)
+    tf.logging.info('Serving %s on http://127.0.0.1:%d' %
+                    (', '.join(sorted(predict_fn_dict)), FLAGS.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    tf.logging.set_verbosity(tf.logging.INFO)
+    tf.app.run()
@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import time
+
+import numpy as np
+
+
+class BatchQueue():
+    """Collect concurrent requests into batches for one forward pass
+
+    Requests are put in a queue, a worker takes up to max_batch_size
+    requests or waits at most max_wait_ms after the first request,
+    runs predict_fn once on the batch in an executor, so the event loop
+    is not blocked, and scatters results back to callers.
+
+    Example:
+        m = ChineseNER(params, gpu=1)
+        queue = BatchQueue(m.ner, max_batch_size=64, max_wait_ms=5)
+        # in a coroutine
+        result = await queue.predict('text')
+
+    Arguments:
+        predict_fn {fn} -- fn that takes a list of inputs and returns
+            a list of results in the same order, e.g. ChineseNER.ner
+
+    Keyword Arguments:
+        max_batch_size {int} -- max batch size (default: {64})
+        max_wait_ms {float} -- max time to wait for a batch to fill (default: {5})
+        latency_window {int} -- number of latest requests kept for
+            latency stats (default: {10000})
+    """
+
+    def __init__(self, predict_fn, max_batch_size=64, max_wait_ms=5,
+                 latency_window=10000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.worker = None
+
+        # metrics
+        self.batch_size_count = collections.Counter()
+        self.latency_list = collections.deque(maxlen=latency_window)
+        self.request_num = 0
+
+    def start(self):
+        """Start the worker, called on the first request if not started"""
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def predict(self, inputs):
+        """Predict one input
+
+        Arguments:
+            inputs {str} -- one input of predict_fn
+
+        Returns:
+            result of predict_fn for inputs
+        """
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((inputs, future, time.time()))
+        return await future
+
+    async def get_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.get_batch()
+            inputs_list = [inputs for inputs, _, _ in batch]
+            try:
+                result_list = list(await loop.run_in_executor(
+                    None, self.predict_fn, inputs_list))
+                # callers without a result would wait forever
+                if len(result_list) != len(batch):
+                    raise ValueError(
+                        'predict_fn returned %d results for %d inputs' % (
+                            len(result_list), len(batch)))
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            end_time = time.time()
+            self.batch_size_count[len(batch)] += 1
+            for (_, future, start_time), result in zip(batch, result_list):
+                self.latency_list.append(end_time - start_time)
+                self.request_num += 1
+                if not future.done():
+                    future.set_result(result)
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def stats(self):
+        """Get queue depth, batch size distribution and latency
+        percentiles in ms
+
+        Returns:
+            dict -- stats
+        """
+        stats = {
+            'queue_depth': self.queue_depth,
+            'request_num': self.request_num,
+            'batch_size_count': dict(self.batch_size_count)
+        }
+        if self.latency_list:
+            latency = np.array(self.latency_list) * 1000
+            for percentile in [50, 90, 99]:
+                stats['latency_p%d_ms' % percentile] = float(
+                    np.percentile(latency, percentile))
+            stats['latency_mean_ms'] = float(latency.mean())
+        return stats
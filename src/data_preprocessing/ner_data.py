@@ -1,4 +1,5 @@
 from glob import glob
+import itertools
 import re
 
 from sklearn.model_selection import train_test_split
@@ -213,35 +214,56 @@ def WeiboSegment(params, mode):
                                            tokenizer)
 
 
+def read_pretrain_documents(file_list, sentence_split):
+    """Stream documents from golden horse data files, one file
+    line at a time
+
+    Arguments:
+        file_list {list} -- data files
+        sentence_split {str} -- regex to split document into sentences
+
+    Yields:
+        list -- document, list of sentences, sentence is list of chars
+    """
+    for file_path in file_list:
+        with open(file_path, 'r', encoding='utf8') as f:
+            document = []
+            for line in itertools.chain(f, ['\n']):
+                if line != '\n':
+                    # first char is input
+                    document.append(line[0])
+                    continue
+                segmented_doc = [list(sentence) for sentence in re.split(
+                    sentence_split, ''.join(document)) if sentence]
+                document = []
+                if segmented_doc:
+                    yield segmented_doc
+
+
 def WeiboPretrain(params, mode):
 
     sentence_split = r'[.!?。？！]'
 
     tokenizer = FullTokenizer(vocab_file=params.vocab_file)
-    data = read_ner_data(file_pattern='data/ner/weiboNER*',
-                         proc_fn=gold_horse_segment_process_fn)
+    file_list = glob('data/ner/weiboNER*')
     if mode == 'train':
-        data = data['train']
+        file_list = [f for f in file_list if 'train' in f or 'dev' in f]
     else:
-        data = data['eval']
-    inputs_list = data['inputs']
+        file_list = [f for f in file_list if not (
+            'train' in f or 'dev' in f)]
 
-    segmented_list = []
-    for document in inputs_list:
-        segmented_list.append([])
-        doc_string = ''.join(document)
-        splited_doc = re.split(sentence_split, doc_string)
-        for sentence in splited_doc:
-            if sentence:
-                segmented_list[-1].append(list(sentence))
-    segmented_list = [doc for doc in segmented_list if doc]
+    inputs_list = read_pretrain_documents(sorted(file_list), sentence_split)
+    if not params.document_store:
+        inputs_list = list(inputs_list)
 
     return create_pretraining_generator('WeiboPretrain',
-                                        segmented_list,
+                                        inputs_list,
                                         None,
                                         None,
                                         params,
-                                        tokenizer)
+                                        tokenizer,
+                                        mode=mode,
+                                        source_files=file_list)
 
 
 def read_bosonnlp_data(file_pattern, eval_size=0.2):
@@ -1,53 +1,279 @@
 
+import collections
+import itertools
+import json
+import time
+
+import numpy as np
 import tensorflow as tf
 
 from bert.tokenization import FullTokenizer
 
 from .model_fn import BertMultiTask
-from .input_fn import predict_input_fn, predict_input_fn_generator
-from .estimator import Estimator
+from .input_fn import (predict_input_fn, predict_input_fn_generator,
+                       predict_window_generator)
 from .utils import get_or_make_label_encoder
-from .params import Params
+from .prediction_cache import normalize_text
+from .tag_decoder import TagDecoder
+from .numpy_engine import NumpyEngine
+from .viterbi import ViterbiDecoder
 
 
 class PredictModel():
-    def __init__(self, params, model_dir=None, gpu=1):
+    """Base class of predictors
+
+    If warm_session, the predict graph is built and the checkpoint
+    is restored once in init_estimator, and every predict call runs
+    the live session. Otherwise every predict call runs
+    Estimator.predict, which rebuilds the graph and restores the
+    checkpoint.
+
+    If params.predict_backend is 'numpy', weights are loaded into a
+    NumpyEngine instead, which runs BERT and tops with numpy.
+
+    Estimator is only built when needed, see estimator.
+
+    If cache, a PredictionCache, is given, predictions of list inputs
+    are looked up in cache first and only missed inputs are predicted.
+    """
+
+    feature_names = ['input_ids', 'input_mask', 'segment_ids']
+
+    def __init__(self, params, model_dir=None, gpu=1, warm_session=True, cache=None):
 
         self.model_dir = model_dir
         self.params = params
         self.gpu = gpu
+        self.warm_session = warm_session
+        self.cache = cache
+        self.sess = None
+        self.engine = None
+        self.checkpoint_path = None
+        self.label_encoder_dict = {}
+        self.decoder_dict = {}
+        # seconds spent in each startup stage
+        self.startup_time = collections.OrderedDict()
         self.tokenizer = FullTokenizer(self.params.vocab_file)
 
     @property
     def label_encoder(self):
-        return get_or_make_label_encoder(self.problem, 'predict')
+        return self.get_label_encoder(self.problem)
+
+    def get_label_encoder(self, problem):
+        """Load label encoder of problem, loaded only once"""
+        if problem not in self.label_encoder_dict:
+            self.label_encoder_dict[problem] = get_or_make_label_encoder(
+                problem, 'predict')
+        return self.label_encoder_dict[problem]
+
+    def get_decoder(self, problem):
+        """TagDecoder of problem, created only once"""
+        if problem not in self.decoder_dict:
+            self.decoder_dict[problem] = TagDecoder(
+                self.get_label_encoder(problem), self.tokenizer)
+        return self.decoder_dict[problem]
 
     def init_estimator(self, problem):
+        start_time = time.time()
         self.params.assign_problem(problem, gpu=int(self.gpu))
 
         # change max length
         self.params.max_seq_len = 250
 
         model = BertMultiTask(params=self.params)
-        model_fn = model.get_model_fn(warm_start=False)
+        self.model_fn = model.get_model_fn(warm_start=False)
+        self.startup_time['assign_problem'] = time.time() - start_time
+
+        self.estimator_model_dir = self.model_dir if self.model_dir is not None else self.params.ckpt_dir
+        self._estimator = None
+
+        if self.params.predict_backend == 'numpy':
+            self.init_numpy_engine(self.estimator_model_dir)
+        elif self.warm_session:
+            self.init_session(self.model_fn, self.estimator_model_dir)
+
+        if self.params.host_crf_decode:
+            self.init_viterbi_decoders()
+
+    @property
+    def estimator(self):
+        """Estimator, built on first use since warm sessions
+        do not need it
+        """
+        if self._estimator is None:
+            from .estimator import Estimator
+
+            if int(self.gpu) > 0:
+                dist_trategy = tf.contrib.distribute.MirroredStrategy(
+                    num_gpus=int(self.gpu),
+                    cross_tower_ops=tf.contrib.distribute.AllReduceCrossTowerOps(
+                        'nccl', num_packs=int(self.gpu)))
+
+                run_config = tf.estimator.RunConfig(
+                    train_distribute=dist_trategy,
+                    eval_distribute=dist_trategy,
+                    log_step_count_steps=self.params.log_every_n_steps)
+            else:
+                run_config = tf.estimator.RunConfig(
+                    log_step_count_steps=self.params.log_every_n_steps)
+
+            self._estimator = Estimator(
+                self.model_fn,
+                model_dir=self.estimator_model_dir,
+                params=self.params,
+                config=run_config)
+        return self._estimator
+
+    def init_session(self, model_fn, model_dir):
+        """Build predict graph with feed placeholders and restore
+        the latest checkpoint in model_dir into a live session
+
+        Arguments:
+            model_fn {fn} -- model fn
+            model_dir {str} -- model dir
+        """
+        checkpoint_path = tf.train.latest_checkpoint(model_dir)
+        if checkpoint_path is None:
+            raise ValueError('No checkpoint found in %s' % model_dir)
+
+        start_time = time.time()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholder_dict = {
+                feature_name: tf.placeholder(
+                    tf.int32, shape=[None, None], name=feature_name)
+                for feature_name in self.feature_names}
+            spec = model_fn(self.placeholder_dict, None,
+                            tf.estimator.ModeKeys.PREDICT, self.params)
+            self.predictions = spec.predictions
+
+            session_config = tf.ConfigProto(allow_soft_placement=True)
+            session_config.gpu_options.allow_growth = True
+            if self.params.predict_intra_op_threads is not None:
+                session_config.intra_op_parallelism_threads = \
+                    self.params.predict_intra_op_threads
+            if self.params.predict_inter_op_threads is not None:
+                session_config.inter_op_parallelism_threads = \
+                    self.params.predict_inter_op_threads
+            saver = tf.train.Saver()
+            self.startup_time['build_graph'] = time.time() - start_time
+
+            start_time = time.time()
+            self.sess = tf.Session(graph=self.graph, config=session_config)
+            saver.restore(self.sess, checkpoint_path)
+            self.checkpoint_path = checkpoint_path
+        self.graph.finalize()
+        self.startup_time['restore_checkpoint'] = time.time() - start_time
+
+    def init_numpy_engine(self, model_dir):
+        """Load weights of the latest checkpoint in model_dir into
+        a NumpyEngine, predictions will not run tensorflow
+        """
+        checkpoint_path = tf.train.latest_checkpoint(model_dir)
+        if checkpoint_path is None:
+            raise ValueError('No checkpoint found in %s' % model_dir)
+
+        start_time = time.time()
+        self.engine = NumpyEngine.from_checkpoint(checkpoint_path, self.params)
+        self.checkpoint_path = checkpoint_path
+        self.startup_time['restore_checkpoint'] = time.time() - start_time
+
+    def init_viterbi_decoders(self):
+        """Create ViterbiDecoder of seq_tag problems from the restored
+        checkpoint, see params.host_crf_decode
+        """
+        if not self.is_warm:
+            raise ValueError('host_crf_decode needs warm_session')
+
+        self.viterbi_decoder_dict = {}
+        for problem_dict in self.params.run_problem_list:
+            for problem, problem_type in problem_dict.items():
+                if problem_type != 'seq_tag':
+                    continue
+                decode_dict = self.get_label_encoder(problem).decode_dict
+                label_list = [decode_dict.get(i, '[PAD]')
+                              for i in range(self.params.num_classes[problem])]
+                self.viterbi_decoder_dict[problem] = ViterbiDecoder.from_checkpoint(
+                    self.checkpoint_path, problem, self.params,
+                    label_list=label_list,
+                    constrained=self.params.crf_constrained)
+
+    @property
+    def is_warm(self):
+        """Whether predictions run a live session or numpy engine"""
+        return self.sess is not None or self.engine is not None
 
-        dist_trategy = tf.contrib.distribute.MirroredStrategy(
-            num_gpus=int(self.gpu),
-            cross_tower_ops=tf.contrib.distribute.AllReduceCrossTowerOps(
-                'nccl', num_packs=int(self.gpu)))
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+        self.engine = None
 
-        run_config = tf.estimator.RunConfig(
-            train_distribute=dist_trategy,
-            eval_distribute=dist_trategy,
-            log_step_count_steps=self.params.log_every_n_steps)
+    def session_predict(self, encoded_data):
+        """Run the live session or numpy engine on encoded data in batches
 
-        model_dir = self.model_dir if self.model_dir is not None else self.params.ckpt_dir
+        Every params.predict_sort_batches batches of examples are sorted
+        by length, batched with padding to the longest example in each
+        batch, and yielded back in the original order.
 
-        self.estimator = Estimator(
-            model_fn,
-            model_dir=model_dir,
-            params=self.params,
-            config=run_config)
+        Arguments:
+            encoded_data {iterable} -- iterable of feature dict,
+                keys: input_ids, input_mask, segment_ids
+
+        Yields:
+            dict -- prediction of one example, same as Estimator.predict
+        """
+        batch_size = self.params.batch_size*2
+        chunk_size = batch_size * self.params.predict_sort_batches
+        chunk = []
+        for d in encoded_data:
+            chunk.append({k: d[k] for k in self.feature_names})
+            if len(chunk) == chunk_size:
+                yield from self.predict_sorted_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self.predict_sorted_chunk(chunk)
+
+    def predict_sorted_chunk(self, chunk):
+        batch_size = self.params.batch_size*2
+        length_list = [int(np.sum(d['input_mask'])) for d in chunk]
+        order = np.argsort(length_list, kind='stable')
+
+        result_list = [None] * len(chunk)
+        for batch_start in range(0, len(order), batch_size):
+            batch_ind = order[batch_start:batch_start+batch_size]
+            batch = [chunk[i] for i in batch_ind]
+            for i, p in zip(batch_ind, self.run_batch(batch)):
+                result_list[i] = p
+        return result_list
+
+    def run_batch(self, batch):
+        """Run one batch, padded to the longest example in batch.
+        seq_tag predictions are padded back to the input length.
+        """
+        batch_len = max([int(np.sum(d['input_mask'])) for d in batch])
+        batch_features = {
+            feature_name: np.array([d[feature_name][:batch_len] for d in batch])
+            for feature_name in self.feature_names}
+        if self.engine is not None:
+            pred = self.engine.predict(batch_features)
+        else:
+            pred = self.sess.run(self.predictions, feed_dict={
+                self.placeholder_dict[feature_name]: feature
+                for feature_name, feature in batch_features.items()})
+        if self.params.host_crf_decode:
+            seq_length = batch_features['input_mask'].sum(axis=-1)
+            for problem, decoder in self.viterbi_decoder_dict.items():
+                pred[problem] = decoder.decode(pred[problem], seq_length)
+        for ind, d in enumerate(batch):
+            result = {}
+            for problem, p in pred.items():
+                p = p[ind]
+                if self.params.problem_type[problem] == 'seq_tag':
+                    p = np.pad(p, [0, len(d['input_ids']) - len(p)],
+                               mode='constant')
+                result[problem] = p
+            yield result
 
     def remove_special_tokens(self, l1, l2):
         ind_list = []
@@ -57,64 +283,383 @@ class PredictModel():
         return [e for ie, e in enumerate(l1) if ie not in ind_list], [e for ie, e in enumerate(l2) if ie not in ind_list]
 
     def predict(self, input_file_or_list):
+        if self.cache is not None and not isinstance(input_file_or_list, str):
+            return self.cached_predict(input_file_or_list)
+        return self.predict_uncached(input_file_or_list)
+
+    def cached_predict(self, input_list):
+        """Look up predictions in cache, predict missed inputs
+        in one pass and put them in cache
+
+        Arguments:
+            input_list {list} -- list of docs
+
+        Returns:
+            list -- prediction of each doc
+        """
+        if self.is_warm:
+            checkpoint_id = self.checkpoint_path
+        else:
+            checkpoint_id = self.estimator.latest_checkpoint()
+        self.cache.set_checkpoint(checkpoint_id)
+
+        result_list = [self.cache.get(doc, self.problem)
+                       for doc in input_list]
+
+        # duplicated misses are predicted once
+        miss_dict = collections.OrderedDict()
+        for ind, (doc, result) in enumerate(zip(input_list, result_list)):
+            if result is None:
+                miss_dict.setdefault(normalize_text(doc), []).append(ind)
+
+        if miss_dict:
+            miss_docs = [input_list[ind_list[0]]
+                         for ind_list in miss_dict.values()]
+            for doc, ind_list, p in zip(
+                    miss_docs, miss_dict.values(), self.predict_uncached(miss_docs)):
+                self.cache.put(doc, self.problem, p)
+                for ind in ind_list:
+                    result_list[ind] = p
+        return result_list
+
+    def predict_uncached(self, input_file_or_list):
+        if self.is_warm:
+            return self.session_predict(predict_input_fn_generator(
+                input_file_or_list, self.params, mode='predict'))
+
         def input_fn(): return predict_input_fn(
             input_file_or_list, self.params, mode='predict')
 
         pred = self.estimator.predict(input_fn=input_fn)
         return pred
 
+    def predict_encoded(self, encoded_data):
+        """Predict already encoded features
 
-class ChineseNER(PredictModel):
+        Arguments:
+            encoded_data {iterable} -- iterable of feature dict,
+                keys: input_ids, input_mask, segment_ids
 
-    def __init__(self, params, model_dir=None, gpu=1):
-        super().__init__(params, model_dir, gpu)
-        self.problem = 'NER'
-        self.init_estimator(self.problem)
+        Returns:
+            iterable -- prediction of each example
+        """
+        if self.is_warm:
+            return self.session_predict(encoded_data)
 
-    def ner(self, input_file_or_list):
-        pred = self.predict(input_file_or_list)
+        feature_names = ['input_ids', 'input_mask', 'segment_ids']
+
+        def gen():
+            for d in encoded_data:
+                yield {feature_name: d[feature_name] for feature_name in feature_names}
+
+        def input_fn():
+            dataset = tf.data.Dataset.from_generator(
+                gen,
+                output_types={
+                    feature_name: tf.int32 for feature_name in feature_names},
+                output_shapes={
+                    feature_name: [self.params.max_seq_len] for feature_name in feature_names})
+            return dataset.batch(self.params.batch_size*2)
+
+        return self.estimator.predict(input_fn=input_fn)
+
+    def predict_encoded_with_inputs(self, encoded_data):
+        """Predict already encoded features, yield each feature dict
+        with its prediction
+
+        Feature dicts are kept in a deque as they are fed and popped as
+        predictions come back in the same order. Without a warm session,
+        the feeding generator runs on a tf.data thread, deque appends and
+        pops are thread safe, unlike itertools.tee.
+
+        Arguments:
+            encoded_data {iterable} -- iterable of feature dict,
+                keys: input_ids, input_mask, segment_ids and others
+
+        Yields:
+            tuple -- feature dict, prediction of one example
+        """
+        fed = collections.deque()
+
+        def feed():
+            for d in encoded_data:
+                fed.append(d)
+                yield d
+
+        for p in self.predict_encoded(feed()):
+            yield fed.popleft(), p
 
+    def window_predict(self, input_file_or_list, stride):
+        """Predict docs longer than max_seq_len with overlapping windows
+
+        Windows of all docs are predicted in the same batches. Tags of
+        each doc are merged back from its windows: where two windows
+        overlap, the first window owns the first half of the overlap
+        and the second window owns the rest, so every token is tagged
+        with the most context on both sides.
+
+        Arguments:
+            input_file_or_list {str or list} -- file path or list of docs
+            stride {int} -- window stride
+
+        Yields:
+            tuple -- input_ids, prediction of one doc, as if the doc
+                was predicted without truncation
+        """
+        windows = predict_window_generator(
+            input_file_or_list, self.params, stride)
+
+        cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(
+            ['[CLS]', '[SEP]'])
+
+        for _, doc_windows in itertools.groupby(
+                self.predict_encoded_with_inputs(windows),
+                key=lambda x: x[0]['doc_ind']):
+            doc_windows = list(doc_windows)
+            doc_len = doc_windows[0][0]['doc_len']
+            starts = [d['window_start'] for d, _ in doc_windows]
+            ends = [min(start + self.params.max_seq_len - 2, doc_len)
+                    for start in starts]
+            bounds = [0] + [(starts[i] + ends[i-1]) // 2
+                            for i in range(1, len(starts))] + [doc_len]
+
+            input_ids = [cls_id]
+            for (d, _), start, own_start, own_end in zip(
+                    doc_windows, starts, bounds[:-1], bounds[1:]):
+                # +1 for [CLS]
+                input_ids += d['input_ids'][own_start -
+                                            start + 1:own_end - start + 1]
+            input_ids.append(sep_id)
+
+            merged_pred = {}
+            for problem, first_pred in doc_windows[0][1].items():
+                # only seq_tag predictions are merged
+                if self.params.problem_type[problem] != 'seq_tag':
+                    merged_pred[problem] = first_pred
+                    continue
+                problem_pred = [first_pred[0]]
+                for (_, p), start, own_start, own_end in zip(
+                        doc_windows, starts, bounds[:-1], bounds[1:]):
+                    problem_pred += list(
+                        p[problem][own_start - start + 1:own_end - start + 1])
+                last_pred = doc_windows[-1][1][problem]
+                problem_pred.append(last_pred[ends[-1] - starts[-1] + 1])
+                merged_pred[problem] = np.array(problem_pred)
+
+            yield input_ids, merged_pred
+
+    def predict_with_inputs(self, input_file_or_list, stride=None):
+        """Predict and yield (input_ids, prediction) of each doc
+
+        Arguments:
+            input_file_or_list {str or list} -- file path or list of docs
+
+        Keyword Arguments:
+            stride {int} -- if set, predict long docs with overlapping
+                windows of this stride instead of truncating (default: {None})
+        """
+        if stride is not None:
+            for input_ids, p in self.window_predict(input_file_or_list, stride):
+                yield input_ids, p
+            return
+
+        # file is read and encoded once, lazily
+        if isinstance(input_file_or_list, str):
+            for d, p in self.predict_encoded_with_inputs(
+                    predict_input_fn_generator(
+                        input_file_or_list, self.params, mode='predict')):
+                yield d['input_ids'], p
+            return
+
+        pred = self.predict(input_file_or_list)
         encoded_data = predict_input_fn_generator(
             input_file_or_list, self.params, mode='predict')
+        for d, p in zip(encoded_data, pred):
+            yield d['input_ids'], p
 
-        result_list = []
+    def predict_decode(self, input_file_or_list, decode_fn, stride=None):
+        """Predict and decode batch_size*2 docs at a time
+
+        Arguments:
+            input_file_or_list {str or list} -- file path or list of docs
+            decode_fn {fn} -- fn(input_ids_list, pred_list) -> list of results
+
+        Keyword Arguments:
+            stride {int} -- see predict_with_inputs (default: {None})
+
+        Yields:
+            decoded result of each doc
+        """
+        chunk_size = self.params.batch_size*2
+        pred_iter = self.predict_with_inputs(input_file_or_list, stride)
+        while True:
+            chunk = list(itertools.islice(pred_iter, chunk_size))
+            if not chunk:
+                break
+            input_ids_list = [input_ids for input_ids, _ in chunk]
+            pred_list = [p for _, p in chunk]
+            for result in decode_fn(input_ids_list, pred_list):
+                yield result
+
+    def predict_file(self, input_file, output_file, decode_fn, format_fn, stride=None):
+        """Predict a file line by line and write decoded results
+        incrementally, so memory stays constant regardless of file size
+
+        Arguments:
+            input_file {str} -- input file, one doc per line
+            output_file {str} -- output file, one result per line
+            decode_fn {fn} -- see predict_decode
+            format_fn {fn} -- fn(result) -> str
+            stride {int} -- see predict_with_inputs (default: {None})
+
+        Returns:
+            int -- number of docs predicted
+        """
+        doc_num = 0
+        with open(output_file, 'w', encoding='utf8') as f:
+            for result in self.predict_decode(input_file, decode_fn, stride):
+                f.write(format_fn(result) + '\n')
+                doc_num += 1
+        return doc_num
+
+    def get_decode_fn(self, problem, decode_type):
+        """Get batch decode fn of problem
+
+        Arguments:
+            problem {str} -- problem name
+            decode_type {str} -- one of ner, cws, entities, cls
+
+        Returns:
+            fn -- fn(input_ids_list, pred_list) -> list of results
+        """
+        decoder = self.get_decoder(problem)
+        decode_method = getattr(decoder, 'decode_%s' % decode_type)
+
+        def decode_fn(input_ids_list, pred_list):
+            return decode_method(input_ids_list, [p[problem] for p in pred_list])
+        return decode_fn
 
-        for d, p in zip(encoded_data, pred):
-            input_ids = d['input_ids']
-            ner_pred = p[self.problem]
-            tokens = self.tokenizer.convert_ids_to_tokens(input_ids)
-            labels = self.label_encoder.inverse_transform(ner_pred)
-            tokens, labels = self.remove_special_tokens(tokens, labels)
-            result_list.append(
-                list(zip(tokens, labels)))
-        return result_list
+
+def format_json(result):
+    return json.dumps(result, ensure_ascii=False, default=str)
+
+
+class ChineseNER(PredictModel):
+
+    def __init__(self, params, model_dir=None, gpu=1, warm_session=True, cache=None):
+        super().__init__(params, model_dir, gpu, warm_session, cache)
+        self.problem = 'NER'
+        self.init_estimator(self.problem)
+
+    def ner(self, input_file_or_list, stride=None):
+        """list of (token, label) of each doc"""
+        return list(self.predict_decode(
+            input_file_or_list, self.get_decode_fn(self.problem, 'ner'), stride))
+
+    def entities(self, input_file_or_list, stride=None):
+        """list of entity dict of each doc,
+        keys: type, start, end, text"""
+        return list(self.predict_decode(
+            input_file_or_list, self.get_decode_fn(self.problem, 'entities'), stride))
+
+    def ner_file(self, input_file, output_file, stride=None):
+        """NER of a file, one doc per line, results are written as
+        json list of [token, label] per line
+        """
+        return self.predict_file(
+            input_file, output_file, self.get_decode_fn(self.problem, 'ner'),
+            format_json, stride)
 
 
 class ChineseWordSegment(PredictModel):
-    def __init__(self, params, model_dir=None, gpu=1):
-        super().__init__(params, model_dir, gpu)
+    def __init__(self, params, model_dir=None, gpu=1, warm_session=True, cache=None):
+        super().__init__(params, model_dir, gpu, warm_session, cache)
         self.problem = 'CWS'
         self.init_estimator(self.problem)
 
-    def cws(self, input_file_or_list):
-        pred = self.predict(input_file_or_list)
+    def cws(self, input_file_or_list, stride=None):
+        """segmented string of each doc"""
+        return list(self.predict_decode(
+            input_file_or_list, self.get_decode_fn(self.problem, 'cws'), stride))
 
-        encoded_data = predict_input_fn_generator(
-            input_file_or_list, self.params, mode='predict')
+    def cws_file(self, input_file, output_file, stride=None):
+        """CWS of a file, one doc per line, results are written as
+        segmented string per line
+        """
+        return self.predict_file(
+            input_file, output_file, self.get_decode_fn(self.problem, 'cws'),
+            lambda result: result.strip(), stride)
 
-        result_list = []
 
-        for d, p in zip(encoded_data, pred):
-            input_ids = d['input_ids']
-            ner_pred = p[self.problem]
-            tokens = self.tokenizer.convert_ids_to_tokens(input_ids)
-            labels = self.label_encoder.inverse_transform(ner_pred)
-            tokens, labels = self.remove_special_tokens(tokens, labels)
-            output_str = ''
-            for char, char_label in zip(tokens, labels):
-                if char_label in ['s', 'e']:
-                    output_str += char + ' '
-                else:
-                    output_str += char
-            result_list.append(output_str)
-        return result_list
+class MultiTaskPredictor(PredictModel):
+    """Run the shared body once and decode every problem's top
+
+    Example:
+        m = MultiTaskPredictor(params, 'NER&CWS', model_dir='tmp/multitask')
+        m.predict_all(['...'])
+        # [{'NER': [(token, label), ...], 'CWS': 'segmented string'}]
+
+    Problems are chained with `&` since they share inputs at
+    prediction time. `|` is treated as `&`.
+    """
+
+    # how to decode each problem, default to 'ner' for seq_tag
+    # and 'cls' for cls
+    decode_type = {
+        'CWS': 'cws',
+        'CTBCWS': 'cws',
+        'WeiboSegment': 'cws'
+    }
+
+    def __init__(self, params, problem, model_dir=None, gpu=1, warm_session=True, cache=None):
+        super().__init__(params, model_dir, gpu, warm_session, cache)
+        self.problem = problem.replace('|', '&')
+        self.problem_list = self.problem.split('&')
+        self.init_estimator(self.problem)
+
+        self.decode_fn_dict = {}
+        for problem in self.problem_list:
+            if self.params.problem_type[problem] == 'cls':
+                decode_type = 'cls'
+            else:
+                decode_type = self.decode_type.get(problem, 'ner')
+            self.decode_fn_dict[problem] = self.get_decode_fn(
+                problem, decode_type)
+
+    def decode_all(self, input_ids_list, pred_list):
+        problem_result_dict = {
+            problem: decode_fn(input_ids_list, pred_list)
+            for problem, decode_fn in self.decode_fn_dict.items()}
+        return [{problem: problem_result_dict[problem][ind]
+                 for problem in self.problem_list}
+                for ind in range(len(input_ids_list))]
+
+    def predict_all(self, input_file_or_list, stride=None):
+        return list(self.predict_decode(
+            input_file_or_list, self.decode_all, stride))
+
+    def predict_all_file(self, input_file, output_file, stride=None):
+        """predict_all of a file, one doc per line, results are
+        written as json dict per line
+        """
+        return self.predict_file(
+            input_file, output_file, self.decode_all, format_json, stride)
+
+
+def get_predictor(params, problem, model_dir=None, gpu=1, **kwargs):
+    """Get predictor of problem, ChineseNER for NER, ChineseWordSegment
+    for CWS and MultiTaskPredictor otherwise
+
+    Returns:
+        tuple -- predictor, dict of endpoint name: predict fn
+    """
+    if problem == 'NER':
+        m = ChineseNER(params, model_dir=model_dir, gpu=gpu, **kwargs)
+        return m, {'ner': m.ner, 'entities': m.entities}
+    elif problem == 'CWS':
+        m = ChineseWordSegment(params, model_dir=model_dir, gpu=gpu, **kwargs)
+        return m, {'cws': m.cws}
+    else:
+        m = MultiTaskPredictor(
+            params, problem, model_dir=model_dir, gpu=gpu, **kwargs)
+        return m, {problem: m.predict_all}
@@ -0,0 +1,270 @@
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import traceback
+
+from .input_fn import read_inputs
+
+
+def get_cpu_list():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def pool_worker(predictor_cls, predictor_kwargs, method, cpu_list,
+                input_queue, output_queue):
+    """Worker process of InferencePool
+
+    Build a warm predictor once, then run predictor.method on every
+    shard from input_queue until None is received. Tasks are
+    (call id, shard index, shard), results are put to output_queue as
+    (call id, shard index, result, error).
+    """
+    # cpu only
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    if cpu_list and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_list)
+
+    try:
+        predictor = predictor_cls(**predictor_kwargs)
+        predict_fn = getattr(predictor, method)
+    except Exception:
+        output_queue.put((None, None, None, traceback.format_exc()))
+        return
+    # ready
+    output_queue.put((None, None, None, None))
+
+    while True:
+        item = input_queue.get()
+        if item is None:
+            break
+        call_id, shard_ind, shard = item
+        try:
+            output_queue.put((call_id, shard_ind, predict_fn(shard), None))
+        except Exception:
+            output_queue.put(
+                (call_id, shard_ind, None, traceback.format_exc()))
+    predictor.close()
+
+
+class InferencePool():
+    """Run a PredictModel in several CPU worker processes
+
+    Each worker holds its own warm session with a fixed number of
+    intra op threads, optionally pinned to its own cpus. Inputs are cut
+    into shards and fed to idle workers, results are merged back in
+    input order.
+
+    Workers are spawned, so the caller script needs an
+    `if __name__ == '__main__':` guard.
+
+    Every imap call tags its shards with its own call id, results of
+    an earlier call that stopped early are discarded. If a worker
+    dies, the pool is terminated and RuntimeError is raised.
+
+    Example:
+        pool = InferencePool(ChineseNER, params, method='ner', worker_num=8,
+                             intra_op_threads=4, model_dir='tmp/NER_ckpt')
+        pool.start()
+        result = pool.map(['...'])
+        pool.map_file('input.txt', 'output.txt')
+        pool.close()
+
+    Arguments:
+        predictor_cls {class} -- subclass of PredictModel
+        params {Params} -- params
+
+    Keyword Arguments:
+        method {str} -- method of predictor that takes a list of docs
+            and returns a list of results (default: {'ner'})
+        worker_num {int} -- number of workers, None to use one worker
+            per intra_op_threads cpus (default: {None})
+        intra_op_threads {int} -- intra op threads of each worker, None to
+            split available cpus evenly (default: {None})
+        shard_size {int} -- docs per shard, None to use
+            batch_size*2 (default: {None})
+        pin_cpu {bool} -- pin each worker to its own cpus (default: {True})
+        poll_interval {float} -- seconds to wait for a result before
+            checking that workers are alive (default: {5.0})
+        **predictor_kwargs -- other arguments of predictor_cls,
+            e.g. model_dir, problem
+    """
+
+    def __init__(self, predictor_cls, params, method='ner', worker_num=None,
+                 intra_op_threads=None, shard_size=None, pin_cpu=True,
+                 poll_interval=5.0, **predictor_kwargs):
+        cpu_list = get_cpu_list()
+        if worker_num is None:
+            if intra_op_threads is None:
+                intra_op_threads = 4
+            worker_num = max(len(cpu_list) // intra_op_threads, 1)
+        if intra_op_threads is None:
+            intra_op_threads = max(len(cpu_list) // worker_num, 1)
+
+        self.worker_num = worker_num
+        self.intra_op_threads = intra_op_threads
+        self.method = method
+        self.poll_interval = poll_interval
+        self.shard_size = shard_size if shard_size is not None else params.batch_size*2
+
+        worker_params = copy.copy(params)
+        worker_params.predict_intra_op_threads = intra_op_threads
+        worker_params.predict_inter_op_threads = 1
+        self.predictor_cls = predictor_cls
+        self.predictor_kwargs = dict(predictor_kwargs)
+        self.predictor_kwargs.update(
+            {'params': worker_params, 'gpu': 0, 'warm_session': True})
+
+        # only pin when every worker can have its own cpus
+        if pin_cpu and worker_num * intra_op_threads <= len(cpu_list):
+            self.worker_cpu_list = [
+                cpu_list[i*intra_op_threads:(i+1)*intra_op_threads]
+                for i in range(worker_num)]
+        else:
+            self.worker_cpu_list = [None] * worker_num
+
+        self.context = multiprocessing.get_context('spawn')
+        self.input_queue = None
+        self.output_queue = None
+        self.worker_list = []
+        self.call_id = 0
+
+    def start(self):
+        """Start workers and wait until all sessions are warm"""
+        if self.worker_list:
+            return
+        self.input_queue = self.context.Queue()
+        self.output_queue = self.context.Queue()
+        for cpu_list in self.worker_cpu_list:
+            worker = self.context.Process(
+                target=pool_worker,
+                args=(self.predictor_cls, self.predictor_kwargs, self.method,
+                      cpu_list, self.input_queue, self.output_queue),
+                daemon=True)
+            worker.start()
+            self.worker_list.append(worker)
+
+        for _ in self.worker_list:
+            _, _, _, error = self.get_output()
+            if error is not None:
+                self.close()
+                raise RuntimeError('Worker failed to start:\n%s' % error)
+
+    def get_output(self):
+        """Get from output_queue, raise RuntimeError if a worker
+        died instead of waiting forever
+        """
+        while True:
+            try:
+                return self.output_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead_list = [w for w in self.worker_list if not w.is_alive()]
+                if dead_list:
+                    exitcode_list = [w.exitcode for w in dead_list]
+                    self.terminate()
+                    raise RuntimeError(
+                        'Worker died with exit code %s' % exitcode_list)
+
+    def close(self):
+        for worker in self.worker_list:
+            if worker.is_alive():
+                self.input_queue.put(None)
+        for worker in self.worker_list:
+            worker.join()
+        self.worker_list = []
+
+    def terminate(self):
+        """Kill workers, start will spawn new ones"""
+        for worker in self.worker_list:
+            worker.terminate()
+        for worker in self.worker_list:
+            worker.join()
+        self.worker_list = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def imap(self, input_file_or_list):
+        """Predict and yield result of each doc in input order
+
+        At most 2*worker_num shards are in flight, so inputs and
+        results are never held in memory at once.
+
+        Arguments:
+            input_file_or_list {str or list} -- file path or list of docs
+
+        Yields:
+            result of predictor.method of each doc
+        """
+        self.start()
+        self.call_id += 1
+        call_id = self.call_id
+        inputs = read_inputs(input_file_or_list)
+        shards = iter(lambda: list(itertools.islice(
+            inputs, self.shard_size)), [])
+        max_in_flight = 2*self.worker_num
+
+        # results that arrive early wait here for their turn
+        done_dict = {}
+        submit_num = 0
+        next_ind = 0
+        for shard in itertools.chain(shards, [None]):
+            if shard is not None:
+                self.input_queue.put((call_id, submit_num, shard))
+                submit_num += 1
+                if submit_num - next_ind < max_in_flight:
+                    continue
+
+            # drain in order, after inputs are exhausted drain all
+            while next_ind < submit_num:
+                while next_ind not in done_dict:
+                    result_call_id, shard_ind, result, error = self.get_output()
+                    if result_call_id != call_id:
+                        # left over from an earlier call
+                        continue
+                    if error is not None:
+                        raise RuntimeError(
+                            'Worker failed on shard %d:\n%s' % (shard_ind, error))
+                    done_dict[shard_ind] = result
+                for r in done_dict.pop(next_ind):
+                    yield r
+                next_ind += 1
+                if shard is not None:
+                    break
+
+    def map(self, input_file_or_list):
+        return list(self.imap(input_file_or_list))
+
+    def map_file(self, input_file, output_file, format_fn=None):
+        """Predict a file, one doc per line, and write one
+        result per line in input order
+
+        Arguments:
+            input_file {str} -- input file
+            output_file {str} -- output file
+
+        Keyword Arguments:
+            format_fn {fn} -- fn(result) -> str, None to dump
+                json (default: {None})
+
+        Returns:
+            int -- number of docs predicted
+        """
+        if format_fn is None:
+            def format_fn(result): return json.dumps(
+                result, ensure_ascii=False, default=str)
+
+        doc_num = 0
+        with open(output_file, 'w', encoding='utf8') as f:
+            for result in self.imap(input_file):
+                f.write(format_fn(result) + '\n')
+                doc_num += 1
+        return doc_num
@@ -1,4 +1,5 @@
 from collections import defaultdict
+import os
 
 import tensorflow as tf
 
@@ -6,21 +7,19 @@ from bert.tokenization import FullTokenizer
 
 from .params import Params
 from .utils import (create_generator, tokenize_text_with_seqs, truncate_seq_pair,
-                    add_special_tokens_with_seqs, create_mask_and_padding)
+                    add_special_tokens_with_seqs, create_mask_and_padding,
+                    create_dynamic_masked_lm_predictions, read_feature_cache)
 
 
-def train_eval_input_fn(config: Params, mode='train', epoch=None):
-
-    def gen():
-        if mode == 'train':
-            epoch = config.train_epoch
-        else:
-            epoch = 1
+def get_output_types_and_shapes(config: Params):
+    """Get output types and shapes of create_generator
 
-        g = create_generator(params=config, mode=mode, epoch=epoch)
-        for example in g:
-            yield example
+    Arguments:
+        config {Params} -- params
 
+    Returns:
+        tuple -- output types dict, output shapes dict
+    """
     output_type = {
         'input_ids': tf.int32,
         'input_mask': tf.int32,
@@ -45,19 +44,45 @@ def train_eval_input_fn(config: Params, mode='train', epoch=None):
                 output_shapes.update({'%s_label_ids' % problem: []})
             elif problem_type in ['pretrain']:
                 output_type.update({
-                    "masked_lm_positions": tf.int32,
-                    "masked_lm_ids": tf.int32,
-                    "masked_lm_weights": tf.float32,
                     "next_sentence_label_ids": tf.int32
                 })
 
                 output_shapes.update({
-                    "masked_lm_positions": [config.max_predictions_per_seq],
-                    "masked_lm_ids": [config.max_predictions_per_seq],
-                    "masked_lm_weights": [config.max_predictions_per_seq],
                     "next_sentence_label_ids": []
                 })
 
+                # with dynamic masking, masked lm features are
+                # created in the pipeline, not by the generator
+                if not config.dynamic_masking:
+                    output_type.update({
+                        "masked_lm_positions": tf.int32,
+                        "masked_lm_ids": tf.int32,
+                        "masked_lm_weights": tf.float32
+                    })
+
+                    output_shapes.update({
+                        "masked_lm_positions": [config.max_predictions_per_seq],
+                        "masked_lm_ids": [config.max_predictions_per_seq],
+                        "masked_lm_weights": [config.max_predictions_per_seq]
+                    })
+
+    return output_type, output_shapes
+
+
+def train_eval_input_fn(config: Params, mode='train', epoch=None):
+
+    def gen():
+        if mode == 'train':
+            epoch = config.train_epoch
+        else:
+            epoch = 1
+
+        g = create_generator(params=config, mode=mode, epoch=epoch)
+        for example in g:
+            yield example
+
+    output_type, output_shapes = get_output_types_and_shapes(config)
+
     tf.logging.info(output_type)
     tf.logging.info(output_shapes)
 
@@ -72,16 +97,110 @@ def train_eval_input_fn(config: Params, mode='train', epoch=None):
         dataset = dataset.batch(config.batch_size)
     else:
         dataset = dataset.batch(config.batch_size*2)
+
+    if config.dynamic_masking and 'masked_lm_positions' not in output_type:
+        dataset = dataset.map(dynamic_masking_fn(config))
     return dataset
 
 
-def predict_input_fn(input_file_or_list, config: Params, mode='predict'):
+def feature_extraction_input_fn(config: Params, mode='train'):
+    """Input fn to extract body features, one pass of data
+    in order, without shuffle
 
-    # if is string, treat it as path to file
-    if isinstance(input_file_or_list, str):
-        inputs = open(input_file_or_list, 'r', encoding='utf8').readlines()
+    Arguments:
+        config {Params} -- params
+
+    Keyword Arguments:
+        mode {str} -- data mode to read (default: {'train'})
+    """
+
+    def gen():
+        g = create_generator(params=config, mode=mode, epoch=1, repeat=False)
+        for example in g:
+            yield example
+
+    output_type, output_shapes = get_output_types_and_shapes(config)
+
+    dataset = tf.data.Dataset.from_generator(
+        gen, output_types=output_type, output_shapes=output_shapes)
+    dataset = dataset.batch(config.batch_size*2)
+    dataset = dataset.prefetch(2)
+    return dataset
+
+
+def cached_feature_input_fn(config: Params, mode='train'):
+    """Input fn that reads body features extracted by
+    feature_extraction_input_fn, see `--schedule extract`
+
+    Arguments:
+        config {Params} -- params
+
+    Keyword Arguments:
+        mode {str} -- mode (default: {'train'})
+    """
+    cache_dir = os.path.join(config.feature_cache_dir, mode)
+
+    def gen():
+        for example in read_feature_cache(cache_dir):
+            yield example
+
+    output_type, output_shapes = get_output_types_and_shapes(config)
+    hidden_size = config.bert_config.hidden_size
+    output_type.update({
+        'seq': tf.as_dtype(config.feature_cache_dtype),
+        'pooled': tf.as_dtype(config.feature_cache_dtype)
+    })
+    output_shapes.update({
+        'seq': [config.max_seq_len, hidden_size],
+        'pooled': [hidden_size]
+    })
+
+    def cast_fn(features):
+        features['seq'] = tf.cast(features['seq'], tf.float32)
+        features['pooled'] = tf.cast(features['pooled'], tf.float32)
+        return features
+
+    dataset = tf.data.Dataset.from_generator(
+        gen, output_types=output_type, output_shapes=output_shapes)
+
+    if mode == 'train':
+        dataset = dataset.repeat(config.train_epoch)
+        dataset = dataset.shuffle(10000)
+        dataset = dataset.batch(config.batch_size)
     else:
-        inputs = input_file_or_list
+        dataset = dataset.batch(config.batch_size*2)
+    dataset = dataset.map(cast_fn)
+    dataset = dataset.prefetch(2)
+    return dataset
+
+
+def dynamic_masking_fn(config: Params):
+    """Create a map fn that masks a batch of pretraining features
+
+    Arguments:
+        config {Params} -- params
+
+    Returns:
+        fn -- map fn for tf.data.Dataset
+    """
+    tokenizer = FullTokenizer(config.vocab_file)
+    mask_id, cls_id, sep_id = tokenizer.convert_tokens_to_ids(
+        ['[MASK]', '[CLS]', '[SEP]'])
+
+    def map_fn(features):
+        return create_dynamic_masked_lm_predictions(
+            features,
+            config.masked_lm_prob,
+            config.max_predictions_per_seq,
+            config.vocab_size,
+            mask_id,
+            [cls_id, sep_id])
+    return map_fn
+
+
+def predict_input_fn(input_file_or_list, config: Params, mode='predict'):
+
+    inputs = read_inputs(input_file_or_list)
 
     tokenizer = FullTokenizer(config.vocab_file)
 
@@ -114,19 +233,26 @@ def predict_input_fn(input_file_or_list, config: Params, mode='predict'):
     return dataset
 
 
-def predict_input_fn_generator(input_file_or_list, config: Params, mode='predict'):
+def read_inputs(input_file_or_list):
+    """Iterate docs of a list, or lines of a file lazily
+
+    Arguments:
+        input_file_or_list {str or list} -- file path or list of docs
+    """
     # if is string, treat it as path to file
     if isinstance(input_file_or_list, str):
-        inputs = open(input_file_or_list, 'r', encoding='utf8').readlines()
+        with open(input_file_or_list, 'r', encoding='utf8') as f:
+            for line in f:
+                yield line
     else:
-        inputs = input_file_or_list
+        for doc in input_file_or_list:
+            yield doc
 
-    tokenizer = FullTokenizer(config.vocab_file)
 
-    data_dict = {}
-    data_dict['input_ids'] = []
-    data_dict['input_mask'] = []
-    data_dict['segment_ids'] = []
+def predict_input_fn_generator(input_file_or_list, config: Params, mode='predict'):
+    inputs = read_inputs(input_file_or_list)
+
+    tokenizer = FullTokenizer(config.vocab_file)
 
     for doc in inputs:
 
@@ -143,12 +269,143 @@ def predict_input_fn_generator(input_file_or_list, config: Params, mode='predict
             tokens, segment_ids, target, config.max_seq_len)
 
         input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        data_dict = {}
         data_dict['input_ids'] = input_ids
         data_dict['input_mask'] = input_mask
         data_dict['segment_ids'] = segment_ids
         yield data_dict
 
 
+def get_window_starts(doc_len, window_size, stride):
+    """Start indices of overlapping windows that cover the doc
+
+    Arguments:
+        doc_len {int} -- number of tokens
+        window_size {int} -- window size
+        stride {int} -- stride, should not be larger than window_size
+
+    Returns:
+        list -- start indices
+    """
+    if stride > window_size:
+        raise ValueError('stride %d larger than window size %d leaves gaps' % (
+            stride, window_size))
+    if doc_len <= window_size:
+        return [0]
+    starts = list(range(0, doc_len - window_size, stride))
+    starts.append(doc_len - window_size)
+    return starts
+
+
+def predict_window_generator(input_file_or_list, config: Params, stride):
+    """Like predict_input_fn_generator, but docs longer than
+    max_seq_len are split into overlapping windows instead of truncated
+
+    Besides input features, each window has:
+        doc_ind: index of doc
+        window_start: token index of window start in doc
+        doc_len: number of tokens in doc
+
+    Arguments:
+        input_file_or_list {str or list} -- file path or list of docs
+        config {Params} -- params
+        stride {int} -- window stride
+    """
+    inputs = read_inputs(input_file_or_list)
+
+    tokenizer = FullTokenizer(config.vocab_file)
+    window_size = config.max_seq_len - 2
+
+    for doc_ind, doc in enumerate(inputs):
+        inputs_a = list(doc)
+        doc_tokens, _ = tokenize_text_with_seqs(tokenizer, inputs_a, None)
+
+        for window_start in get_window_starts(len(doc_tokens), window_size, stride):
+            tokens_a = doc_tokens[window_start:window_start+window_size]
+
+            tokens, segment_ids, _ = add_special_tokens_with_seqs(
+                tokens_a, None, None)
+
+            input_mask, tokens, segment_ids, _ = create_mask_and_padding(
+                tokens, segment_ids, None, config.max_seq_len)
+
+            yield {
+                'input_ids': tokenizer.convert_tokens_to_ids(tokens),
+                'input_mask': input_mask,
+                'segment_ids': segment_ids,
+                'doc_ind': doc_ind,
+                'window_start': window_start,
+                'doc_len': len(doc_tokens)
+            }
+
+
+def serving_input_fn(config: Params):
+    """Serving input receiver fn for export_saved_model
+
+    Default signature takes raw strings, 'ids' signature takes
+    input_ids, input_mask and segment_ids directly.
+
+    Strings are tokenized in graph by character, which is the same
+    as FullTokenizer for Chinese text. Text with non-Chinese words
+    should use 'ids' signature with FullTokenizer to match training.
+
+    Arguments:
+        config {Params} -- params
+
+    Returns:
+        fn -- serving input receiver fn
+    """
+    tokenizer = FullTokenizer(config.vocab_file)
+    cls_id, sep_id, unk_id = tokenizer.convert_tokens_to_ids(
+        ['[CLS]', '[SEP]', '[UNK]'])
+
+    def receiver_fn():
+        text = tf.placeholder(tf.string, shape=[None], name='text')
+
+        # split to characters, whitespaces are dropped
+        chars = tf.regex_replace(text, '\\s', '')
+        chars = tf.string_split(
+            tf.regex_replace(chars, '(.)', '\\1 '), delimiter=' ')
+        chars = tf.sparse_tensor_to_dense(chars, default_value='[PAD]')
+        chars = chars[:, :config.max_seq_len-2]
+        seq_length = tf.reduce_sum(
+            tf.cast(tf.not_equal(chars, '[PAD]'), tf.int32), axis=-1)
+
+        table = tf.contrib.lookup.index_table_from_file(
+            config.vocab_file, default_value=unk_id)
+        char_ids = tf.cast(table.lookup(chars), tf.int32)
+
+        # [CLS] chars [SEP] [PAD]...
+        batch_size = tf.shape(char_ids)[0]
+        cls_ids = tf.fill([batch_size, 1], cls_id)
+        pad_ids = tf.zeros([batch_size, 1], dtype=tf.int32)
+        text_ids = tf.concat([cls_ids, char_ids, pad_ids], axis=1)
+        positions = tf.range(tf.shape(text_ids)[1])[tf.newaxis, :]
+        text_ids = tf.where(
+            tf.equal(positions, seq_length[:, tf.newaxis] + 1),
+            tf.fill(tf.shape(text_ids), sep_id),
+            text_ids)
+        text_mask = tf.cast(
+            positions <= seq_length[:, tf.newaxis] + 1, tf.int32)
+
+        # feeding these directly skips tokenization
+        features = {
+            'input_ids': tf.placeholder_with_default(
+                text_ids, shape=[None, None], name='input_ids'),
+            'input_mask': tf.placeholder_with_default(
+                text_mask, shape=[None, None], name='input_mask'),
+            'segment_ids': tf.placeholder_with_default(
+                tf.zeros_like(text_ids), shape=[None, None], name='segment_ids')
+        }
+
+        return tf.estimator.export.ServingInputReceiver(
+            features,
+            receiver_tensors={'text': text},
+            receiver_tensors_alternatives={'ids': features})
+
+    return receiver_fn
+
+
 def no_dataset_input_fn(config: Params, mode='train', epoch=None):
     """This function is for evaluation only
 
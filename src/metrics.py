@@ -1,193 +1,357 @@
 import numpy as np
-import os
+import tensorflow as tf
 
-import pickle
+from .tag_decoder import pad_sequences, extract_spans, extract_bmes_spans
+from .utils import get_or_make_label_encoder
+from .viterbi import parse_label
 
-from .input_fn import no_dataset_input_fn
+
+def safe_divide(numerator, denominator):
+    """Element-wise division, -1 where denominator is 0"""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.where(denominator > 0, numerator / np.maximum(denominator, 1), -1.0)
+
+
+def get_f_measure(precision, recall):
+    """F measure, -1 if precision or recall is not defined"""
+    valid = (precision != -1) & (recall != -1) & (precision + recall > 0)
+    return np.where(valid, 2 * precision * recall / np.where(
+        valid, precision + recall, 1), -1.0)
+
+
+def get_spans(label_ids, valid, tables, label_type):
+    """Extract entity spans of padded label ids
+
+    Arguments:
+        label_ids {np.array} -- int, [batch, seq]
+        valid {np.array} -- bool, [batch, seq]
+        tables {dict} -- tag tables, see NERMetric
+        label_type {str} -- BMES or BIO
+
+    Returns:
+        np.array -- int, [num_spans, 4], (batch index, start, end, type id)
+    """
+    def is_tag(tag): return tables[tag][label_ids] & valid
+
+    type_ids = tables['type'][label_ids]
+    if label_type == 'BMES':
+        return extract_bmes_spans(
+            is_tag('B'), is_tag('M'), is_tag('E'), is_tag('S'), type_ids)
+    return extract_spans(is_tag('B'), is_tag('I'), type_ids)
+
+
+def get_span_keys(spans, seq_len, num_types):
+    """Encode spans to int keys, so spans can be matched with
+    set operations of numpy
+    """
+    batch_ind, start, end, type_ids = spans.T
+    return ((batch_ind * seq_len + start) * (seq_len + 1) + end) * num_types + type_ids
+
+
+def get_label_list(problem, params):
+    """Label of each label id of problem, ids missing in label
+    encoder are [PAD]
+    """
+    decode_dict = get_or_make_label_encoder(problem, 'eval').decode_dict
+    return [decode_dict.get(i, '[PAD]')
+            for i in range(params.num_classes[problem])]
+
+
+def get_label_type(label_list):
+    """BMES if any label is M, E or S, otherwise BIO"""
+    tags = [parse_label(label)[0] for label in label_list]
+    return 'BMES' if any([tag in ['M', 'E', 'S'] for tag in tags]) else 'BIO'
+
+
+class NERMetric():
+    """Accumulate tag accuracy and entity precision, recall and F1,
+    overall and per entity type
+
+    Spans are extracted from label id arrays of a whole batch of
+    sentences at once, and matched as int keys, so predictions can be
+    streamed batch by batch.
+
+    Arguments:
+        label_list {list} -- label of each label id
+
+    Keyword Arguments:
+        label_type {str} -- BMES or BIO (default: {'BMES'})
+    """
+
+    def __init__(self, label_list, label_type='BMES'):
+        self.label_type = label_type.upper()
+        parsed = [parse_label(label) for label in label_list]
+        self.type_list = sorted(set(
+            [entity_type for tag, entity_type in parsed if tag not in [None, 'O']]))
+        type_ind = {t: i for i, t in enumerate(self.type_list)}
+
+        # an extra label at the end for padding
+        self.pad_id = len(label_list)
+        self.tables = {
+            tag: np.array([t == tag for t, _ in parsed] + [False])
+            for tag in ['B', 'I', 'M', 'E', 'S']}
+        self.tables['type'] = np.array(
+            [type_ind.get(entity_type, -1) for _, entity_type in parsed] + [-1])
+
+        num_types = len(self.type_list)
+        self.right_tag = 0
+        self.all_tag = 0
+        self.right_count = np.zeros(num_types, dtype=np.int64)
+        self.golden_count = np.zeros(num_types, dtype=np.int64)
+        self.predict_count = np.zeros(num_types, dtype=np.int64)
+
+    def update(self, golden_ids_list, predict_ids_list):
+        """Add a batch of sentences
+
+        Arguments:
+            golden_ids_list {list} -- gold label ids of each sentence
+            predict_ids_list {list} -- predicted label ids of each sentence
+        """
+        if not len(golden_ids_list):
+            return
+        golden_ids, valid = pad_sequences(golden_ids_list, self.pad_id)
+        predict_ids, _ = pad_sequences(
+            [p[:len(g)] for g, p in zip(golden_ids_list, predict_ids_list)],
+            self.pad_id)
+
+        self.right_tag += int(np.sum((golden_ids == predict_ids) & valid))
+        self.all_tag += int(np.sum(valid))
+
+        num_types = max(len(self.type_list), 1)
+        seq_len = golden_ids.shape[1]
+        golden_spans = get_spans(golden_ids, valid, self.tables, self.label_type)
+        predict_spans = get_spans(predict_ids, valid, self.tables, self.label_type)
+        right_keys = np.intersect1d(
+            get_span_keys(golden_spans, seq_len, num_types),
+            get_span_keys(predict_spans, seq_len, num_types))
+
+        minlength = len(self.type_list)
+        self.golden_count += np.bincount(golden_spans[:, 3], minlength=minlength)
+        self.predict_count += np.bincount(predict_spans[:, 3], minlength=minlength)
+        self.right_count += np.bincount(right_keys % num_types, minlength=minlength)
+
+    def result(self):
+        """Get accuracy, precision, recall and f measure,
+        -1 if not defined
+        """
+        precision = safe_divide(self.right_count.sum(), self.predict_count.sum())
+        recall = safe_divide(self.right_count.sum(), self.golden_count.sum())
+        f_measure = get_f_measure(precision, recall)
+        accuracy = safe_divide(self.right_tag, self.all_tag)
+        return float(accuracy), float(precision), float(recall), float(f_measure)
+
+    def result_per_type(self):
+        """Get precision, recall, f measure and number of gold
+        entities of each entity type
+
+        Returns:
+            dict -- type: (precision, recall, f1, support)
+        """
+        precision = safe_divide(self.right_count, self.predict_count)
+        recall = safe_divide(self.right_count, self.golden_count)
+        f_measure = get_f_measure(precision, recall)
+        return {entity_type: (float(precision[i]), float(recall[i]),
+                              float(f_measure[i]), int(self.golden_count[i]))
+                for i, entity_type in enumerate(self.type_list)}
 
 
 def get_ner_fmeasure(golden_lists, predict_lists, label_type="BMES"):
-    sent_num = len(golden_lists)
-    golden_full = []
-    predict_full = []
-    right_full = []
-    right_tag = 0
-    all_tag = 0
-    for idx in range(0, sent_num):
-        # word_list = sentence_lists[idx]
-        golden_list = golden_lists[idx]
-        predict_list = predict_lists[idx]
-        for idy in range(len(golden_list)):
-            if golden_list[idy] == predict_list[idy]:
-                right_tag += 1
-        all_tag += len(golden_list)
-        if label_type == "BMES":
-            gold_matrix = get_ner_BMES(golden_list)
-            pred_matrix = get_ner_BMES(predict_list)
-        else:
-            gold_matrix = get_ner_BIO(golden_list)
-            pred_matrix = get_ner_BIO(predict_list)
-        # print "gold", gold_matrix
-        # print "pred", pred_matrix
-        right_ner = list(set(gold_matrix).intersection(set(pred_matrix)))
-        golden_full += gold_matrix
-        predict_full += pred_matrix
-        right_full += right_ner
-    right_num = len(right_full)
-    golden_num = len(golden_full)
-    predict_num = len(predict_full)
-    if predict_num == 0:
-        precision = -1
-    else:
-        precision = (right_num+0.0)/predict_num
-    if golden_num == 0:
-        recall = -1
+    """Get accuracy, precision, recall and f measure of label lists
+
+    Arguments:
+        golden_lists {list} -- gold labels of each sentence
+        predict_lists {list} -- predicted labels of each sentence
+
+    Keyword Arguments:
+        label_type {str} -- BMES or BIO (default: {"BMES"})
+
+    Returns:
+        tuple -- accuracy, precision, recall, f measure
+    """
+    label_list = sorted(set(
+        [label for labels in golden_lists + predict_lists for label in labels]))
+    label_ind = {label: i for i, label in enumerate(label_list)}
+
+    def to_ids(labels): return np.array(
+        [label_ind[label] for label in labels], dtype=np.int64)
+
+    metric = NERMetric(label_list, label_type)
+    metric.update([to_ids(labels) for labels in golden_lists],
+                  [to_ids(labels) for labels in predict_lists])
+    return metric.result()
+
+
+def ner_evaluate(problem_list, pred, params):
+    """Evaluate NER problems in one streaming pass of predictions
+
+    pred should be predicted from eval data, e.g. train_eval_input_fn
+    with mode='eval', so that every prediction carries its gold labels,
+    input_mask and loss multipliers, see BertMultiTask.create_spec.
+    Examples of other problems, whose loss multiplier is 0, are skipped.
+
+    Arguments:
+        problem_list {list} -- NER problems to evaluate
+        pred {iterable} -- predictions, e.g. estimator.predict
+        params {Params} -- params
+
+    Returns:
+        dict -- problem: (accuracy, precision, recall, f1)
+    """
+    metric_dict = {}
+    for problem in problem_list:
+        label_list = get_label_list(problem, params)
+        metric_dict[problem] = NERMetric(
+            label_list, label_type=get_label_type(label_list))
+
+    # sentences are buffered and added to metrics batch by batch
+    buffer_size = params.batch_size*2
+    buffer_dict = {problem: ([], []) for problem in problem_list}
+
+    def flush(problem):
+        golden_ids_list, predict_ids_list = buffer_dict[problem]
+        metric_dict[problem].update(golden_ids_list, predict_ids_list)
+        buffer_dict[problem] = ([], [])
+
+    for p in pred:
+        true_seq_length = np.sum(p['input_mask']) - 1
+        for problem in problem_list:
+            if not p['%s_loss_multiplier' % problem]:
+                continue
+
+            # crf returns tags, [CLS] and [SEP] are excluded
+            golden_ids_list, predict_ids_list = buffer_dict[problem]
+            golden_ids_list.append(
+                p['%s_label_ids' % problem][1:true_seq_length])
+            predict_ids_list.append(p[problem][1:true_seq_length])
+            if len(golden_ids_list) == buffer_size:
+                flush(problem)
+
+    result_dict = {}
+    for problem in problem_list:
+        flush(problem)
+        result_dict[problem] = metric_dict[problem].result()
+        for metric_name, result in zip(['Acc', 'Precision', 'Recall', 'F1'],
+                                       result_dict[problem]):
+            print('%s %s Score: %f' % (problem, metric_name, result))
+        for entity_type, (precision, recall, f1, support) in \
+                metric_dict[problem].result_per_type().items():
+            print('%s %s Precision: %f Recall: %f F1: %f Support: %d' % (
+                problem, entity_type, precision, recall, f1, support))
+    return result_dict
+
+
+def get_span_starts(label_ids, valid, tables, label_type):
+    """In graph, find where entities start and how long they are
+
+    Positions are linked to the previous one if they continue an
+    entity. Unlinked positions start segments, and an entity is a
+    segment starting with B (or S for BMES), that ends with E for BMES.
+
+    Arguments:
+        label_ids {tensor} -- int, [batch, seq]
+        valid {tensor} -- bool, [batch, seq]
+        tables {dict} -- tag tables, see NERMetric
+        label_type {str} -- BMES or BIO
+
+    Returns:
+        tuple -- whether an entity starts at position, bool [batch, seq];
+            entity length, int [batch, seq]; entity type, int [batch, seq]
+    """
+    def lookup(table):
+        return tf.gather(tf.constant(table), label_ids)
+
+    def is_tag(tag): return tf.logical_and(lookup(tables[tag]), valid)
+    type_ids = lookup(tables['type'])
+
+    def shift(x):
+        # value of previous position, False at the first position
+        return tf.pad(x[:, :-1], [[0, 0], [1, 0]])
+
+    same_type = tf.equal(type_ids, tf.pad(
+        type_ids[:, :-1], [[0, 0], [1, 0]], constant_values=-2))
+    if label_type == 'BMES':
+        link = tf.logical_or(is_tag('M'), is_tag('E'))
+        prev_open = shift(tf.logical_or(is_tag('B'), is_tag('M')))
     else:
-        recall = (right_num+0.0)/golden_num
-    if (precision == -1) or (recall == -1) or (precision+recall) <= 0.:
-        f_measure = -1
+        link = is_tag('I')
+        prev_open = shift(tf.logical_or(is_tag('B'), is_tag('I')))
+    link = tf.logical_and(tf.logical_and(link, same_type), prev_open)
+
+    # segment id of every position, flattened so rows never share
+    # a segment since the first position never links
+    flat_break = tf.reshape(tf.logical_not(link), [-1])
+    segment_ids = tf.cumsum(tf.cast(flat_break, tf.int32)) - 1
+    num_segments = tf.size(segment_ids)
+    segment_len = tf.gather(tf.unsorted_segment_sum(
+        tf.ones_like(segment_ids), segment_ids, num_segments), segment_ids)
+    segment_len = tf.reshape(segment_len, tf.shape(label_ids))
+
+    if label_type == 'BMES':
+        has_end = tf.gather(tf.unsorted_segment_max(
+            tf.cast(tf.reshape(is_tag('E'), [-1]), tf.int32),
+            segment_ids, num_segments), segment_ids)
+        has_end = tf.reshape(tf.cast(has_end, tf.bool), tf.shape(label_ids))
+        is_start = tf.logical_or(
+            is_tag('S'), tf.logical_and(is_tag('B'), has_end))
     else:
-        f_measure = 2*precision*recall/(precision+recall)
-    accuracy = (right_tag+0.0)/all_tag
-    # print "Accuracy: ", right_tag,"/",all_tag,"=",accuracy
-    return accuracy, precision, recall, f_measure
-
-
-def reverse_style(input_string):
-    target_position = input_string.index('[')
-    input_len = len(input_string)
-    output_string = input_string[target_position:input_len] + \
-        input_string[0:target_position]
-    return output_string
-
-
-def get_ner_BMES(label_list):
-    # list_len = len(word_list)
-    # assert(list_len == len(label_list)), "word list size unmatch with label list"
-    list_len = len(label_list)
-    begin_label = 'B-'
-    end_label = 'E-'
-    single_label = 'S-'
-    whole_tag = ''
-    index_tag = ''
-    tag_list = []
-    stand_matrix = []
-    for i in range(0, list_len):
-        # wordlabel = word_list[i]
-        current_label = label_list[i].upper()
-        if begin_label in current_label:
-            if index_tag != '':
-                tag_list.append(whole_tag + ',' + str(i-1))
-            whole_tag = current_label.replace(
-                begin_label, "", 1) + '[' + str(i)
-            index_tag = current_label.replace(begin_label, "", 1)
-
-        elif single_label in current_label:
-            if index_tag != '':
-                tag_list.append(whole_tag + ',' + str(i-1))
-            whole_tag = current_label.replace(
-                single_label, "", 1) + '[' + str(i)
-            tag_list.append(whole_tag)
-            whole_tag = ""
-            index_tag = ""
-        elif end_label in current_label:
-            if index_tag != '':
-                tag_list.append(whole_tag + ',' + str(i))
-            whole_tag = ''
-            index_tag = ''
-        else:
-            continue
-    if (whole_tag != '') & (index_tag != ''):
-        tag_list.append(whole_tag)
-    tag_list_len = len(tag_list)
-
-    for i in range(0, tag_list_len):
-        if len(tag_list[i]) > 0:
-            tag_list[i] = tag_list[i] + ']'
-            insert_list = reverse_style(tag_list[i])
-            stand_matrix.append(insert_list)
-    # print stand_matrix
-    return stand_matrix
-
-
-def get_ner_BIO(label_list):
-    # list_len = len(word_list)
-    # assert(list_len == len(label_list)), "word list size unmatch with label list"
-    list_len = len(label_list)
-    begin_label = 'B-'
-    inside_label = 'I-'
-    whole_tag = ''
-    index_tag = ''
-    tag_list = []
-    stand_matrix = []
-    for i in range(0, list_len):
-        # wordlabel = word_list[i]
-        current_label = label_list[i].upper()
-        if begin_label in current_label:
-            if index_tag == '':
-                whole_tag = current_label.replace(
-                    begin_label, "", 1) + '[' + str(i)
-                index_tag = current_label.replace(begin_label, "", 1)
-            else:
-                tag_list.append(whole_tag + ',' + str(i-1))
-                whole_tag = current_label.replace(
-                    begin_label, "", 1) + '[' + str(i)
-                index_tag = current_label.replace(begin_label, "", 1)
-
-        elif inside_label in current_label:
-            if current_label.replace(inside_label, "", 1) == index_tag:
-                whole_tag = whole_tag
-            else:
-                if (whole_tag != '') & (index_tag != ''):
-                    tag_list.append(whole_tag + ',' + str(i-1))
-                whole_tag = ''
-                index_tag = ''
-        else:
-            if (whole_tag != '') & (index_tag != ''):
-                tag_list.append(whole_tag + ',' + str(i-1))
-            whole_tag = ''
-            index_tag = ''
-
-    if (whole_tag != '') & (index_tag != ''):
-        tag_list.append(whole_tag)
-    tag_list_len = len(tag_list)
-
-    for i in range(0, tag_list_len):
-        if len(tag_list[i]) > 0:
-            tag_list[i] = tag_list[i] + ']'
-            insert_list = reverse_style(tag_list[i])
-            stand_matrix.append(insert_list)
-    return stand_matrix
-
-
-def ner_evaluate(problem, pred_list, params):
-    label_data = no_dataset_input_fn(params, mode='eval')
-    lable_data_list = list(label_data)
-
-    label_encoder = pickle.load(open(
-        os.path.join('tmp', problem+'_ckpt', '%s_lable_encoder.pkl' % problem), 'rb'))
-
-    decode_pred_list = []
-    decode_label_list = []
-
-    for p, label_data in zip(pred_list, lable_data_list):
-        label = label_data['%s_label_ids' % problem]
-        true_seq_length = np.sum(label_data['input_mask']) - 1
-
-        pred_prob = p[1:true_seq_length]
-
-        # crf returns tags
-        predict = pred_prob
-        label = label[1:true_seq_length]
-
-        decode_pred = label_encoder.inverse_transform(predict)
-        decode_label = label_encoder.inverse_transform(label)
-
-        decode_pred_list.append(decode_pred)
-        decode_label_list.append(decode_label)
-
-    for metric_name, result in zip(['Acc', 'Precision', 'Recall', 'F1'],
-                                   get_ner_fmeasure(decode_label_list,
-                                                    decode_pred_list,
-                                                    label_type='BIO')):
-        print('%s Score: %f' % (metric_name,  result))
+        is_start = is_tag('B')
+    return is_start, segment_len, type_ids
+
+
+def entity_metric_ops(label_ids, pred_ids, input_mask, label_list, label_type=None):
+    """Streaming entity level precision, recall and F1 for
+    Estimator eval_metric_ops, in graph counterpart of NERMetric
+
+    A predicted entity is right if a gold entity starts at the same
+    position with the same type and length.
+
+    Arguments:
+        label_ids {tensor} -- gold label ids, [batch, seq]
+        pred_ids {tensor} -- predicted label ids, e.g. crf_decode, [batch, seq]
+        input_mask {tensor} -- input mask, [batch, seq]
+        label_list {list} -- label of each label id
+
+    Keyword Arguments:
+        label_type {str} -- BMES or BIO, None to detect
+            from label_list (default: {None})
+
+    Returns:
+        dict -- metric name: (value, update_op)
+    """
+    if label_type is None:
+        label_type = get_label_type(label_list)
+    tables = NERMetric(label_list, label_type).tables
+    # score the same tokens as ner_evaluate, without [CLS]
+    # at the first position and [SEP] at the last valid position
+    input_mask = tf.cast(input_mask, tf.int32)
+    positions = tf.range(tf.shape(input_mask)[1])[tf.newaxis, :]
+    seq_length = tf.reduce_sum(input_mask, axis=-1, keepdims=True)
+    valid = tf.logical_and(positions >= 1, positions < seq_length - 1)
+
+    gold_start, gold_len, gold_type = get_span_starts(
+        label_ids, valid, tables, label_type)
+    pred_start, pred_len, pred_type = get_span_starts(
+        pred_ids, valid, tables, label_type)
+    right = tf.logical_and(
+        tf.logical_and(gold_start, pred_start),
+        tf.logical_and(tf.equal(gold_len, pred_len), tf.equal(gold_type, pred_type)))
+
+    # true_positives counts positions where both are True
+    right_num, right_update = tf.metrics.true_positives(right, right)
+    golden_num, golden_update = tf.metrics.true_positives(gold_start, gold_start)
+    predict_num, predict_update = tf.metrics.true_positives(pred_start, pred_start)
+    update_op = tf.group(right_update, golden_update, predict_update)
+
+    def safe_div(numerator, denominator):
+        return tf.where(denominator > 0, numerator / tf.maximum(denominator, 1.0),
+                        tf.zeros_like(numerator))
+
+    precision = safe_div(right_num, predict_num)
+    recall = safe_div(right_num, golden_num)
+    f1 = safe_div(2 * precision * recall, precision + recall)
+    return {
+        'Entity Precision': (precision, update_op),
+        'Entity Recall': (recall, update_op),
+        'Entity F1': (f1, update_op)
+    }
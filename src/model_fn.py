@@ -1,5 +1,7 @@
+import copy
+import re
+
 import tensorflow as tf
-from tensorflow.contrib import autograph
 
 from bert import modeling
 from bert.modeling import BertModel
@@ -9,22 +11,12 @@ from .optimizer import AdamWeightDecayOptimizer
 from .top import cls, seq_tag, pretrain
 
 
-@autograph.convert()
-def make_grad(global_step, loss_eval_pred, hidden_features, tvars, freeze_step):
-    if global_step <= freeze_step:
-        grads = tf.gradients(loss_eval_pred, tvars,
-                             stop_gradients=hidden_features)
-    else:
-        grads = tf.gradients(loss_eval_pred, tvars)
-
-    return grads
-
-
 class BertMultiTask():
     def __init__(self, params: Params):
+        params.check_problem_layer()
         self.config = params
 
-    def body(self, features, mode):
+    def body(self, features, mode, encoder_depth=None):
         """Body of the model, aka Bert
 
         Arguments:
@@ -32,6 +24,10 @@ class BertMultiTask():
                 keys: input_ids, input_mask, segment_ids
             mode {mode} -- mode
 
+        Keyword Arguments:
+            encoder_depth {int} -- if set, only build the bottom
+                encoder_depth layers (default: {None})
+
         Returns:
             dict -- features extracted from bert.
                 keys: 'seq', 'pooled', 'all', 'embed'
@@ -51,13 +47,19 @@ class BertMultiTask():
         input_mask = features["input_mask"]
         segment_ids = features["segment_ids"]
         is_training = (mode == tf.estimator.ModeKeys.TRAIN)
+
+        bert_config = config.bert_config
+        if encoder_depth is not None and encoder_depth < bert_config.num_hidden_layers:
+            bert_config = copy.deepcopy(bert_config)
+            bert_config.num_hidden_layers = encoder_depth
+
         model = BertModel(
-            config=config.bert_config,
+            config=bert_config,
             is_training=is_training,
             input_ids=input_ids,
             input_mask=input_mask,
             token_type_ids=segment_ids,
-            use_one_hot_embeddings=config.use_one_hot_embeddings)
+            use_one_hot_embeddings=self.use_one_hot_embeddings(input_ids))
 
         feature_dict = {}
         for logit_type in ['seq', 'pooled', 'all', 'embed', 'embed_table']:
@@ -78,6 +80,74 @@ class BertMultiTask():
 
         return feature_dict
 
+    def use_one_hot_embeddings(self, input_ids):
+        """Whether to look up embeddings with one hot matmul or gather
+
+        If params.use_one_hot_embeddings is set, it will be used.
+        Otherwise, one hot is only used on accelerators when the
+        [batch_size*seq_length, vocab_size] one hot matrix is small enough.
+        Gather is used on CPU and produces IndexedSlices gradients,
+        which AdamWeightDecayOptimizer applies with _apply_sparse.
+
+        Devices are not probed, the device type comes from the device of
+        input_ids or params.gpu. Since batches are not padded to full
+        size, unknown dims are bounded by the largest batch of the
+        input fn, batch_size*2, and max_seq_len.
+
+        Arguments:
+            input_ids {tensor} -- input ids, [batch_size, seq_length]
+
+        Returns:
+            bool -- use one hot embeddings
+        """
+        if self.config.use_one_hot_embeddings is not None:
+            return self.config.use_one_hot_embeddings
+
+        device_type = tf.DeviceSpec.from_string(
+            input_ids.device).device_type
+        if not device_type:
+            device_type = 'GPU' if self.config.gpu else 'CPU'
+        device_type = device_type.upper()
+
+        if device_type == 'TPU':
+            return True
+        if device_type != 'GPU':
+            return False
+
+        batch_size, seq_length = input_ids.shape.as_list()
+        if batch_size is None:
+            batch_size = self.config.batch_size * 2
+        if seq_length is None:
+            seq_length = self.config.max_seq_len
+        one_hot_size = batch_size * seq_length * self.config.vocab_size
+        return one_hot_size <= self.config.one_hot_embeddings_max_size
+
+    def get_encoder_depth(self, problem):
+        """Get which encoder layer the top of problem consumes,
+        see params.problem_layer. Only seq_tag problems can
+        use a layer other than the last one.
+
+        Arguments:
+            problem {str} -- problem name
+
+        Returns:
+            int -- encoder layer, starting from 1
+        """
+        num_hidden_layers = self.config.bert_config.num_hidden_layers
+        if self.config.problem_type[problem] != 'seq_tag':
+            return num_hidden_layers
+        return self.config.problem_layer.get(problem, num_hidden_layers)
+
+    def get_problem_hidden_feature(self, hidden_feature, problem):
+        """Replace 'seq' with the encoder layer problem consumes"""
+        encoder_depth = self.get_encoder_depth(problem)
+        if 'all' not in hidden_feature or \
+                encoder_depth == len(hidden_feature['all']):
+            return hidden_feature
+        problem_hidden_feature = dict(hidden_feature)
+        problem_hidden_feature['seq'] = hidden_feature['all'][encoder_depth-1]
+        return problem_hidden_feature
+
     def top(self, features, hidden_feature, mode):
         """Top model. This fn will return:
         1. loss, if mode is train
@@ -100,18 +170,21 @@ class BertMultiTask():
                 else:
                     top_scope_name = '%s_top' % problem
 
+                problem_hidden_feature = self.get_problem_hidden_feature(
+                    hidden_feature, problem)
+
                 if self.config.problem_type[problem] == 'pretrain':
                     return_dict[problem] = pretrain(
-                        self, features, hidden_feature, mode, problem)
+                        self, features, problem_hidden_feature, mode, problem)
 
                 with tf.variable_scope(top_scope_name, reuse=tf.AUTO_REUSE):
                     if self.config.problem_type[problem] == 'seq_tag':
                         return_dict[problem] = \
                             seq_tag(self, features,
-                                    hidden_feature, mode, problem)
+                                    problem_hidden_feature, mode, problem)
                     elif self.config.problem_type[problem] == 'cls':
                         return_dict[problem] = \
-                            cls(self, features, hidden_feature, mode, problem)
+                            cls(self, features, problem_hidden_feature, mode, problem)
 
         return return_dict
 
@@ -164,6 +237,139 @@ class BertMultiTask():
 
         return optimizer
 
+    def get_frozen_variables(self, tvars):
+        """Get body variables to freeze according to params
+
+        If params.freeze_layers is None, the whole body is frozen.
+        Otherwise embeddings and the bottom freeze_layers encoder
+        layers are frozen.
+
+        Arguments:
+            tvars {list} -- trainable variables
+
+        Returns:
+            list -- frozen variables
+        """
+        if not self.config.freeze_body:
+            return []
+
+        freeze_layers = self.config.freeze_layers
+        frozen_vars = []
+        for var in tvars:
+            if not var.name.startswith('bert/'):
+                continue
+            if freeze_layers is None or var.name.startswith('bert/embeddings/'):
+                frozen_vars.append(var)
+                continue
+            layer_match = re.match(r'^bert/encoder/layer_(\d+)/', var.name)
+            if layer_match and int(layer_match.group(1)) < freeze_layers:
+                frozen_vars.append(var)
+        return frozen_vars
+
+    def get_frozen_boundary(self, hidden_features):
+        """Outputs of the frozen part of the body that the rest of
+        the model consumes, see get_frozen_variables
+
+        Arguments:
+            hidden_features {dict} -- hidden feature dict extracted by bert
+
+        Returns:
+            list -- tensors
+        """
+        boundary = [hidden_features['embed'], hidden_features['embed_table']]
+        if self.config.freeze_layers is None:
+            boundary += hidden_features['all'] + [hidden_features['pooled']]
+        else:
+            boundary += hidden_features['all'][:self.config.freeze_layers]
+        return boundary
+
+    def create_frozen_grads(self, total_loss, tvars, frozen_vars, hidden_features):
+        """Create gradients with frozen variables
+
+        If params.freeze_step is None, frozen variables are simply
+        excluded from gradients and optimizer.
+
+        Otherwise, frozen variables will be trained after freeze_step.
+        The backward pass stops at the outputs of the frozen part, see
+        get_frozen_boundary, which gives gradients of trainable variables
+        and of the boundary. Gradients of frozen variables are
+        backpropagated from the boundary inside a tf.cond, so the backward
+        pass of the frozen part only runs after freeze_step. Before that
+        their gradients are zeros. Since they will be trained later,
+        their optimizer slots are created.
+
+        Arguments:
+            total_loss {tensor} -- loss
+            tvars {list} -- trainable variables
+            frozen_vars {list} -- frozen variables
+            hidden_features {dict} -- hidden feature dict extracted by bert
+
+        Returns:
+            tuple -- grads, vars of trainable vars; grads, vars of frozen
+                vars, frozen vars grads is None if permanently frozen
+        """
+        frozen_names = set(v.name for v in frozen_vars)
+        train_vars = [v for v in tvars if v.name not in frozen_names]
+
+        if self.config.freeze_step is None:
+            grads = tf.gradients(
+                total_loss, train_vars,
+                aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE)
+            return grads, train_vars, None, []
+
+        # partial gradients of the boundary, each boundary tensor is
+        # treated as independent, so paths between them are not
+        # counted twice when backpropagating from all of them
+        boundary = self.get_frozen_boundary(hidden_features)
+        all_grads = tf.gradients(
+            total_loss, train_vars + boundary,
+            stop_gradients=boundary,
+            aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE)
+        grads = all_grads[:len(train_vars)]
+        boundary_pairs = [(b, g) for b, g in zip(
+            boundary, all_grads[len(train_vars):]) if g is not None]
+        if not boundary_pairs:
+            return grads, train_vars, None, []
+
+        global_step = tf.train.get_or_create_global_step()
+        self.is_frozen = tf.less(global_step, self.config.freeze_step)
+
+        # tf.cond builds the true branch first, which decides which
+        # frozen vars get gradients, the false branch returns zeros
+        # of the same structure
+        frozen_grad_list = []
+
+        def _body_grads():
+            body_grads = tf.gradients(
+                [b for b, _ in boundary_pairs], frozen_vars,
+                grad_ys=[g for _, g in boundary_pairs],
+                aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE)
+            frozen_grad_list.extend(
+                [(v, g) for v, g in zip(frozen_vars, body_grads) if g is not None])
+            return [g for _, g in frozen_grad_list]
+
+        def _frozen_grads():
+            zero_grads = []
+            for v, g in frozen_grad_list:
+                if isinstance(g, tf.IndexedSlices):
+                    # keep embedding gradients sparse
+                    zero_grads.append(tf.IndexedSlices(
+                        tf.zeros([0] + g.values.shape.as_list()[1:], g.values.dtype),
+                        tf.zeros([0], g.indices.dtype),
+                        tf.shape(v, out_type=g.dense_shape.dtype)))
+                else:
+                    zero_grads.append(tf.zeros(v.shape, g.dtype))
+            return zero_grads
+
+        frozen_grads = tf.cond(
+            tf.logical_not(self.is_frozen), _body_grads, _frozen_grads)
+        if not frozen_grad_list:
+            return grads, train_vars, None, []
+        if not isinstance(frozen_grads, (list, tuple)):
+            frozen_grads = [frozen_grads]
+
+        return grads, train_vars, list(frozen_grads), [v for v, _ in frozen_grad_list]
+
     def create_train_spec(self, features, hidden_features, loss_eval_pred, mode, scaffold_fn):
         optimizer = self.create_optimizer(
             self.config.lr,
@@ -173,6 +379,7 @@ class BertMultiTask():
         global_step = tf.train.get_or_create_global_step()
 
         tvars = tf.trainable_variables()
+        frozen_vars = self.get_frozen_variables(tvars)
 
         total_loss = 0
         hook_dict = {}
@@ -187,17 +394,45 @@ class BertMultiTask():
         logging_hook = tf.train.LoggingTensorHook(
             hook_dict, every_n_iter=self.config.log_every_n_steps)
 
-        grads = tf.gradients(
-            total_loss, tvars,
-            aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE)
-        # grads = make_grad(global_step, loss_eval_pred,
-        #                   hidden_features, tvars, self.config.freeze_step)
+        if not frozen_vars:
+            grads = tf.gradients(
+                total_loss, tvars,
+                aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE)
 
-        # This is how the model was pre-trained.
-        (grads, _) = tf.clip_by_global_norm(grads, clip_norm=1.0)
+            # This is how the model was pre-trained.
+            (grads, _) = tf.clip_by_global_norm(grads, clip_norm=1.0)
 
-        train_op = optimizer.apply_gradients(
-            zip(grads, tvars), global_step=global_step)
+            train_op = optimizer.apply_gradients(
+                zip(grads, tvars), global_step=global_step)
+        else:
+            grads, tvars, frozen_grads, frozen_vars = self.create_frozen_grads(
+                total_loss, tvars, frozen_vars, hidden_features)
+            if frozen_grads is None:
+                (grads, _) = tf.clip_by_global_norm(grads, clip_norm=1.0)
+                train_op = optimizer.apply_gradients(
+                    zip(grads, tvars), global_step=global_step)
+            else:
+                (all_grads, _) = tf.clip_by_global_norm(
+                    grads + frozen_grads, clip_norm=1.0)
+                grads = all_grads[:len(grads)]
+                frozen_grads = all_grads[len(grads):]
+
+                train_op = optimizer.apply_gradients(
+                    zip(grads, tvars), global_step=global_step)
+
+                # frozen vars use their own optimizer, which
+                # skips updates while frozen
+                frozen_optimizer = AdamWeightDecayOptimizer(
+                    learning_rate=self.learning_rate,
+                    weight_decay_rate=0.01,
+                    beta_1=0.9,
+                    beta_2=0.999,
+                    epsilon=1e-6,
+                    exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"],
+                    apply_condition=tf.logical_not(self.is_frozen))
+                frozen_train_op = frozen_optimizer.apply_gradients(
+                    zip(frozen_grads, frozen_vars))
+                train_op = tf.group(train_op, frozen_train_op)
 
         new_global_step = global_step + 1
         train_op = tf.group(train_op, [global_step.assign(new_global_step)])
@@ -267,15 +502,61 @@ class BertMultiTask():
                 eval_metric_ops=total_eval_metric)
             return output_spec
         else:
+            # carry gold labels along predictions if features have them,
+            # so predictions of eval data can be evaluated in one pass
+            predictions = dict(loss_eval_pred)
+            for problem_dict in self.config.run_problem_list:
+                for problem in problem_dict:
+                    for feature_name in ['%s_label_ids' % problem, '%s_loss_multiplier' % problem]:
+                        if feature_name in features:
+                            predictions[feature_name] = features[feature_name]
+            if len(predictions) > len(loss_eval_pred):
+                predictions['input_mask'] = features['input_mask']
             output_spec = tf.estimator.EstimatorSpec(
-                mode=mode, predictions=loss_eval_pred)
+                mode=mode, predictions=predictions)
             return output_spec
 
+    def get_feature_extraction_model_fn(self):
+        """Model fn that only runs body and returns 'seq' and 'pooled'
+        features along with input features, see `--schedule extract`
+        """
+        def model_fn(features, labels, mode, params: Params):
+            hidden_feature = self.body(
+                features, tf.estimator.ModeKeys.PREDICT)
+
+            predictions = dict(features)
+            predictions['seq'] = hidden_feature['seq']
+            predictions['pooled'] = hidden_feature['pooled']
+            return tf.estimator.EstimatorSpec(
+                mode=mode, predictions=predictions)
+
+        return model_fn
+
     def get_model_fn(self, warm_start=True):
         def model_fn(features, labels, mode, params: Params):
 
-            hidden_feature = self.body(
-                features, mode)
+            problem_list = [problem for problem_dict in self.config.run_problem_list
+                            for problem in problem_dict]
+
+            if self.config.use_cached_features:
+                for problem in problem_list:
+                    if self.config.problem_type[problem] not in ['seq_tag', 'cls']:
+                        raise ValueError(
+                            'Cached features only support seq_tag and cls problems, got %s' % problem)
+                    if problem in self.config.problem_layer:
+                        raise ValueError(
+                            'Cached features only contain the last encoder layer, got problem_layer for %s' % problem)
+                hidden_feature = {
+                    'seq': features['seq'], 'pooled': features['pooled']}
+            else:
+                # stop the encoder at the deepest layer problems need
+                if mode == tf.estimator.ModeKeys.TRAIN:
+                    encoder_depth = None
+                else:
+                    encoder_depth = max(
+                        [self.get_encoder_depth(problem) for problem in problem_list])
+                hidden_feature = self.body(
+                    features, mode, encoder_depth=encoder_depth)
 
             loss_eval_pred = self.top(features, hidden_feature, mode)
 
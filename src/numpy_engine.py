@@ -0,0 +1,239 @@
+import numpy as np
+
+from .viterbi import viterbi_decode
+
+
+def erf(x):
+    """Error function, Abramowitz and Stegun 7.1.26,
+    max absolute error 1.5e-7, below float32 precision of gelu
+    """
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    y = 1.0 - (((((1.061405429 * t - 1.453152027) * t) + 1.421413741)
+                * t - 0.284496736) * t + 0.254829592) * t * np.exp(-x * x)
+    return sign * y
+
+
+def gelu(x):
+    return x * 0.5 * (1.0 + erf(x / np.sqrt(2.0)))
+
+
+ACTIVATION_FNS = {
+    'gelu': gelu,
+    'relu': lambda x: np.maximum(x, 0),
+    'tanh': np.tanh,
+    'linear': lambda x: x
+}
+
+
+def layer_norm(x, gamma, beta, epsilon=1e-12):
+    mean = x.mean(axis=-1, keepdims=True)
+    variance = np.square(x - mean).mean(axis=-1, keepdims=True)
+    return (x - mean) / np.sqrt(variance + epsilon) * gamma + beta
+
+
+def softmax(x, axis=-1):
+    x = x - x.max(axis=axis, keepdims=True)
+    exp_x = np.exp(x)
+    return exp_x / exp_x.sum(axis=axis, keepdims=True)
+
+
+class NumpyEngine():
+    """Run BERT and seq_tag/cls tops with numpy, without tensorflow
+
+    Weights are read from a checkpoint once (this needs tensorflow),
+    and can be saved to a npz file, so that serving only needs numpy.
+
+    Example:
+        params.assign_problem('NER', gpu=1)
+        engine = NumpyEngine.from_checkpoint('tmp/NER_ckpt', params)
+        engine.save('tmp/NER_ckpt/numpy_weights.npz')
+
+        # serving
+        engine = NumpyEngine.load('tmp/NER_ckpt/numpy_weights.npz', params)
+        pred = engine.predict(
+            {'input_ids': ..., 'input_mask': ..., 'segment_ids': ...})
+
+    Arguments:
+        weights {dict} -- variable name: np.array
+        params {Params} -- params with problems assigned
+    """
+
+    def __init__(self, weights, params):
+        self.weights = {k: v.astype(np.float32) for k, v in weights.items()}
+        self.params = params
+        self.bert_config = params.bert_config
+
+        self.problem_list = [problem for problem_dict in params.run_problem_list
+                             for problem in problem_dict]
+        for problem in self.problem_list:
+            if params.problem_type[problem] not in ['seq_tag', 'cls']:
+                raise ValueError(
+                    'NumpyEngine only supports seq_tag and cls problems, got %s' % problem)
+
+        self.top_scope_dict = {
+            problem: '%s_top' % params.share_top.get(problem, problem)
+            for problem in self.problem_list}
+
+    @staticmethod
+    def get_variable_names(params):
+        """Names of variables needed by problems assigned in params"""
+        names = ['bert/embeddings/word_embeddings',
+                 'bert/embeddings/token_type_embeddings',
+                 'bert/embeddings/position_embeddings',
+                 'bert/embeddings/LayerNorm/gamma',
+                 'bert/embeddings/LayerNorm/beta',
+                 'bert/pooler/dense/kernel',
+                 'bert/pooler/dense/bias']
+        for layer_ind in range(params.bert_config.num_hidden_layers):
+            prefix = 'bert/encoder/layer_%d/' % layer_ind
+            for layer_name in ['attention/self/query', 'attention/self/key',
+                               'attention/self/value', 'attention/output/dense',
+                               'intermediate/dense', 'output/dense']:
+                names += [prefix + layer_name + '/kernel',
+                          prefix + layer_name + '/bias']
+            for layer_name in ['attention/output/LayerNorm', 'output/LayerNorm']:
+                names += [prefix + layer_name + '/gamma',
+                          prefix + layer_name + '/beta']
+
+        for problem_dict in params.run_problem_list:
+            for problem in problem_dict:
+                top_scope = '%s_top' % params.share_top.get(problem, problem)
+                names += [top_scope + '/dense/kernel', top_scope + '/dense/bias']
+                if params.problem_type[problem] == 'seq_tag':
+                    names.append(top_scope + '/crf_transition')
+        return sorted(set(names))
+
+    @classmethod
+    def from_checkpoint(cls, model_dir_or_checkpoint, params):
+        """Read weights from the latest checkpoint in model dir,
+        or from a checkpoint path
+        """
+        import tensorflow as tf
+
+        checkpoint_path = tf.train.latest_checkpoint(model_dir_or_checkpoint)
+        if checkpoint_path is None:
+            checkpoint_path = model_dir_or_checkpoint
+        reader = tf.train.load_checkpoint(checkpoint_path)
+        weights = {name: reader.get_tensor(name)
+                   for name in cls.get_variable_names(params)}
+        return cls(weights, params)
+
+    @classmethod
+    def load(cls, weights_file, params):
+        with np.load(weights_file) as f:
+            weights = {name: f[name] for name in f.files}
+        return cls(weights, params)
+
+    def save(self, weights_file):
+        np.savez(weights_file, **self.weights)
+
+    def dense(self, x, name, activation='linear'):
+        x = np.matmul(x, self.weights[name + '/kernel']) + \
+            self.weights[name + '/bias']
+        return ACTIVATION_FNS[activation](x)
+
+    def layer_norm(self, x, name):
+        return layer_norm(x, self.weights[name + '/gamma'], self.weights[name + '/beta'])
+
+    def embed(self, input_ids, segment_ids):
+        seq_len = input_ids.shape[1]
+        embedding = self.weights['bert/embeddings/word_embeddings'][input_ids] + \
+            self.weights['bert/embeddings/token_type_embeddings'][segment_ids] + \
+            self.weights['bert/embeddings/position_embeddings'][np.newaxis, :seq_len]
+        return self.layer_norm(embedding, 'bert/embeddings/LayerNorm')
+
+    def attention(self, hidden, attention_adder, prefix):
+        batch_size, seq_len, hidden_size = hidden.shape
+        num_heads = self.bert_config.num_attention_heads
+        head_size = hidden_size // num_heads
+
+        def split_heads(x):
+            # [batch, heads, seq, head_size]
+            return x.reshape(batch_size, seq_len, num_heads, head_size).transpose(0, 2, 1, 3)
+
+        query = split_heads(self.dense(hidden, prefix + 'attention/self/query'))
+        key = split_heads(self.dense(hidden, prefix + 'attention/self/key'))
+        value = split_heads(self.dense(hidden, prefix + 'attention/self/value'))
+
+        scores = np.matmul(query, key.transpose(0, 1, 3, 2)) / np.sqrt(head_size)
+        probs = softmax(scores + attention_adder)
+        context = np.matmul(probs, value).transpose(
+            0, 2, 1, 3).reshape(batch_size, seq_len, hidden_size)
+        return context
+
+    def encoder(self, input_ids, input_mask, segment_ids, encoder_depth):
+        """Run embeddings and the bottom encoder_depth layers
+
+        Returns:
+            list -- output of each layer, [batch, seq, hidden_size]
+        """
+        hidden = self.embed(input_ids, segment_ids)
+        # [batch, 1, 1, seq]
+        attention_adder = (1.0 - input_mask[:, np.newaxis, np.newaxis, :].astype(
+            np.float32)) * -10000.0
+
+        all_layers = []
+        for layer_ind in range(encoder_depth):
+            prefix = 'bert/encoder/layer_%d/' % layer_ind
+            attention_output = self.dense(
+                self.attention(hidden, attention_adder, prefix),
+                prefix + 'attention/output/dense')
+            attention_output = self.layer_norm(
+                attention_output + hidden, prefix + 'attention/output/LayerNorm')
+
+            intermediate = self.dense(
+                attention_output, prefix + 'intermediate/dense',
+                self.bert_config.hidden_act)
+            hidden = self.layer_norm(
+                self.dense(intermediate, prefix + 'output/dense') + attention_output,
+                prefix + 'output/LayerNorm')
+            all_layers.append(hidden)
+        return all_layers
+
+    def get_encoder_depth(self, problem):
+        """Same as BertMultiTask.get_encoder_depth"""
+        num_hidden_layers = self.bert_config.num_hidden_layers
+        if self.params.problem_type[problem] != 'seq_tag':
+            return num_hidden_layers
+        return self.params.problem_layer.get(problem, num_hidden_layers)
+
+    def predict(self, features):
+        """Predict a batch, same outputs as the PREDICT spec of
+        BertMultiTask
+
+        Arguments:
+            features {dict} -- np.array of [batch, seq],
+                keys: input_ids, input_mask, segment_ids
+
+        Returns:
+            dict -- problem: tags [batch, seq] for seq_tag,
+                probs [batch, num_classes] for cls
+        """
+        input_ids = np.asarray(features['input_ids'])
+        input_mask = np.asarray(features['input_mask'])
+        segment_ids = np.asarray(features['segment_ids'])
+
+        encoder_depth = max([self.get_encoder_depth(problem)
+                             for problem in self.problem_list])
+        all_layers = self.encoder(
+            input_ids, input_mask, segment_ids, encoder_depth)
+
+        pred = {}
+        for problem in self.problem_list:
+            top_scope = self.top_scope_dict[problem]
+            if self.params.problem_type[problem] == 'seq_tag':
+                hidden = all_layers[self.get_encoder_depth(problem) - 1]
+                logits = self.dense(hidden, top_scope + '/dense')
+                if self.params.host_crf_decode:
+                    pred[problem] = logits
+                else:
+                    pred[problem], _ = viterbi_decode(
+                        logits, self.weights[top_scope + '/crf_transition'],
+                        input_mask.sum(axis=-1))
+            else:
+                pooled = self.dense(
+                    all_layers[-1][:, 0], 'bert/pooler/dense', 'tanh')
+                pred[problem] = softmax(self.dense(pooled, top_scope + '/dense'))
+        return pred
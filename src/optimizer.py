@@ -16,7 +16,11 @@ from tensorflow.python.ops import resource_variable_ops
 
 
 class AdamWeightDecayOptimizer(optimizer.Optimizer):
-    """A basic Adam optimizer that includes "correct" L2 weight decay."""
+    """A basic Adam optimizer that includes "correct" L2 weight decay.
+
+    If apply_condition, a bool tensor, is given, variables and slots
+    are only updated when it's True.
+    """
 
     def __init__(self,
                  learning_rate,
@@ -25,7 +29,8 @@ class AdamWeightDecayOptimizer(optimizer.Optimizer):
                  beta_2=0.999,
                  epsilon=1e-6,
                  exclude_from_weight_decay=None,
-                 name="AdamWeightDecayOptimizer"):
+                 name="AdamWeightDecayOptimizer",
+                 apply_condition=None):
         """Constructs a AdamWeightDecayOptimizer."""
         super(AdamWeightDecayOptimizer, self).__init__(False, name)
 
@@ -35,6 +40,7 @@ class AdamWeightDecayOptimizer(optimizer.Optimizer):
         self.beta_2 = beta_2
         self.epsilon = epsilon
         self.exclude_from_weight_decay = exclude_from_weight_decay
+        self.apply_condition = apply_condition
 
     def _prepare(self):
         self.learning_rate_t = ops.convert_to_tensor(
@@ -50,7 +56,16 @@ class AdamWeightDecayOptimizer(optimizer.Optimizer):
             self._zeros_slot(v, 'm', self._name)
             self._zeros_slot(v, 'v', self._name)
 
+    def _maybe_apply(self, apply_fn):
+        """Run apply_fn, skipped when apply_condition is False"""
+        if self.apply_condition is None:
+            return apply_fn()
+        return tf.cond(self.apply_condition, apply_fn, control_flow_ops.no_op)
+
     def _apply_dense(self, grad, var):
+        return self._maybe_apply(lambda: self._dense_update(grad, var))
+
+    def _dense_update(self, grad, var):
         learning_rate_t = math_ops.cast(
             self.learning_rate_t, var.dtype.base_dtype)
         beta_1_t = math_ops.cast(self.beta_1_t, var.dtype.base_dtype)
@@ -84,6 +99,9 @@ class AdamWeightDecayOptimizer(optimizer.Optimizer):
                                         v.assign(next_v)])
 
     def _resource_apply_dense(self, grad, var):
+        return self._maybe_apply(lambda: self._resource_dense_update(grad, var))
+
+    def _resource_dense_update(self, grad, var):
         learning_rate_t = math_ops.cast(
             self.learning_rate_t, var.dtype.base_dtype)
         beta_1_t = math_ops.cast(self.beta_1_t, var.dtype.base_dtype)
@@ -153,10 +171,10 @@ class AdamWeightDecayOptimizer(optimizer.Optimizer):
         return control_flow_ops.group(*[var_update, m_t, v_t])
 
     def _apply_sparse(self, grad, var):
-        return self._apply_sparse_shared(
+        return self._maybe_apply(lambda: self._apply_sparse_shared(
             grad.values, var, grad.indices,
             lambda x, i, v: state_ops.scatter_add(  # pylint: disable=g-long-lambda
-                x, i, v, use_locking=self._use_locking))
+                x, i, v, use_locking=self._use_locking)))
 
     def _resource_scatter_add(self, x, i, v):
         with ops.control_dependencies(
@@ -165,8 +183,8 @@ class AdamWeightDecayOptimizer(optimizer.Optimizer):
             return x.value()
 
     def _resource_apply_sparse(self, grad, var, indices):
-        return self._apply_sparse_shared(
-            grad, var, indices, self._resource_scatter_add)
+        return self._maybe_apply(lambda: self._apply_sparse_shared(
+            grad, var, indices, self._resource_scatter_add))
 
     def _do_use_weight_decay(self, param_name):
         """Whether to use L2 weight decay for `param_name`."""
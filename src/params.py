@@ -3,7 +3,22 @@ import re
 
 from bert.modeling import BertConfig
 
-from . import data_preprocessing
+
+class ReadDataFnDict(dict):
+    """Generator functions of problems, looked up in data_preprocessing
+    on first access, so data_preprocessing and its dependencies are
+    only imported when data is read
+    """
+
+    def __missing__(self, problem):
+        from . import data_preprocessing
+        try:
+            read_data_fn = getattr(data_preprocessing, problem)
+        except AttributeError:
+            raise KeyError(
+                '%s function not implemented in data_preprocessing' % problem)
+        self[problem] = read_data_fn
+        return read_data_fn
 
 
 class Params():
@@ -48,21 +63,34 @@ class Params():
             'CTBCWS': 'CWS'
         }
 
+        # which encoder layer the top of seq_tag problem consumes,
+        # starting from 1, default to the last layer
+        # prediction will stop the encoder at the deepest layer needed
+        # e.g. {'CWS': 6}
+        self.problem_layer = {}
+
         self.multitask_balance_type = 'data_balanced'
         # self.multitask_balance_type = 'problem_balanced'
 
+        # number of batches sorted by length together in prediction
+        self.predict_sort_batches = 32
+        # 'tf' to predict with a tensorflow session, 'numpy' to
+        # predict seq_tag and cls problems with NumpyEngine
+        self.predict_backend = 'tf'
+        # if True, seq_tag predictions are decoded on host with numpy
+        # instead of crf_decode in graph, needs a warm session
+        self.host_crf_decode = False
+        # forbid illegal BIO/BMES transitions in host decoding
+        self.crf_constrained = False
+        # threads of the prediction session, None for tensorflow default
+        self.predict_intra_op_threads = None
+        self.predict_inter_op_threads = None
+
         # logging control
         self.log_every_n_steps = 10
 
-        # get generator function for each problem
-        self.read_data_fn = {}
-        for problem in self.problem_type:
-            try:
-                self.read_data_fn[problem] = getattr(
-                    data_preprocessing, problem)
-            except AttributeError:
-                raise AttributeError(
-                    '%s function not implemented in data_preprocessing.py' % problem)
+        # get generator function for each problem, lazily
+        self.read_data_fn = ReadDataFnDict()
 
         problem_list = sorted(self.problem_type.keys())
         self.ckpt_dir = os.path.join('tmp', '_'.join(problem_list)+'_ckpt')
@@ -74,16 +102,38 @@ class Params():
 
         # training
         self.init_checkpoint = self.pretrain_ckpt
-        self.freeze_body = False
         self.lr = 2e-5
         self.batch_size = 32
         self.train_epoch = 10
+
+        # freeze body
+        # freeze_layers: None to freeze the whole body, N to freeze
+        #   embeddings and the bottom N encoder layers
+        # freeze_step: None to freeze permanently, N to freeze
+        #   the first N steps
+        self.freeze_body = False
+        self.freeze_layers = None
         self.freeze_step = 50
 
+        # cached features
+        # if True, tops are trained on body features extracted
+        # by `--schedule extract`, the body is not run
+        self.use_cached_features = False
+        self.feature_cache_dtype = 'float16'
+        # examples per shard, a shard is held in memory before it's
+        # written, 1000 examples of [250, 768] float16 is about 400MB
+        self.feature_cache_shard_size = 1000
+
         # hparm
         self.dropout_keep_prob = 0.9
         self.max_seq_len = 90
-        self.use_one_hot_embeddings = True
+        # number of gpu, set by assign_problem, 0 for cpu
+        self.gpu = 0
+        # None: choose by device type and batch shape,
+        # see BertMultiTask.use_one_hot_embeddings
+        self.use_one_hot_embeddings = None
+        # max size of the [batch*seq, vocab_size] one hot matrix
+        self.one_hot_embeddings_max_size = 32 * 128 * 21128
 
         # bert config
         self.bert_config = BertConfig.from_json_file(
@@ -91,16 +141,42 @@ class Params():
 
         # pretrain hparm
         self.dupe_factor = 10
+        # if True, store unmasked sequences once and apply masking
+        # inside the input pipeline, dupe_factor is ignored
+        self.dynamic_masking = False
+        # if True, tokenized pretraining documents are stored in
+        # a memory-mapped DocumentStore instead of python lists
+        self.document_store = False
         self.short_seq_prob = 0.1
         self.masked_lm_prob = 0.15
         self.max_predictions_per_seq = 20
         self.mask_lm_hidden_size = 768
         self.mask_lm_hidden_act = 'gelu'
         self.mask_lm_initializer_range = 0.02
+        # if set, use sampled softmax with this many samples
+        # for mask lm loss while training. Negatives are sampled
+        # uniformly from the vocab, since bert vocab is not sorted
+        # by frequency as the default log uniform sampler assumes
+        self.mask_lm_num_sampled = None
         with open(os.path.join(self.pretrain_ckpt, 'vocab.txt'), 'r') as vf:
             self.vocab_size = len(vf.readlines())
 
+    def check_problem_layer(self):
+        """Raise ValueError if a problem_layer is not in
+        1..num_hidden_layers
+        """
+        num_hidden_layers = self.bert_config.num_hidden_layers
+        for problem, layer in self.problem_layer.items():
+            if not 1 <= layer <= num_hidden_layers:
+                raise ValueError(
+                    'problem_layer of %s should be in 1..%d, got %s' % (
+                        problem, num_hidden_layers, layer))
+
     def assign_problem(self, flag_string, gpu=2):
+        self.check_problem_layer()
+        self.gpu = gpu
+        # gpu=0 runs on one cpu device
+        num_devices = max(gpu, 1)
         for flag_chunk in flag_string.split('|'):
 
             if '&' not in flag_chunk:
@@ -116,6 +192,8 @@ class Params():
         problem_list = sorted(re.split(r'[&|]', flag_string))
 
         self.ckpt_dir = os.path.join('tmp', '_'.join(problem_list)+'_ckpt')
+        self.feature_cache_dir = os.path.join(
+            'tmp', '_'.join(problem_list)+'_features')
 
         # update data_num and train_steps
         self.data_num = 0
@@ -128,13 +206,13 @@ class Params():
             else:
                 self.data_num += self.data_num_dict[problem]
 
-        if self.problem_type[problem] == 'pretrain':
+        if self.problem_type[problem] == 'pretrain' and not self.dynamic_masking:
             dup_fac = self.dupe_factor
         else:
             dup_fac = 1
         self.train_steps = int((
-            self.data_num * self.train_epoch * dup_fac) / (self.batch_size*gpu))
+            self.data_num * self.train_epoch * dup_fac) / (self.batch_size*num_devices))
         self.num_warmup_steps = int(0.1 * self.train_steps)
 
         # linear scale learing rate
-        self.lr = self.lr * gpu
+        self.lr = self.lr * num_devices
@@ -0,0 +1,92 @@
+import collections
+import sys
+
+import numpy as np
+
+
+def normalize_text(text):
+    """Collapse whitespaces, which the tokenizer drops anyway"""
+    return ' '.join(text.split())
+
+
+class PredictionCache():
+    """Bounded LRU cache of predictions
+
+    Keyed by normalized text, problem and checkpoint id. The cache is
+    cleared when the checkpoint changes, see set_checkpoint.
+
+    Example:
+        cache = PredictionCache(max_bytes=256 * 1024 * 1024)
+        m = ChineseNER(params, gpu=1, cache=cache)
+        m.ner(['...'])
+        cache.stats()
+
+    Keyword Arguments:
+        max_bytes {int} -- max size of cached texts and predictions (default: {64MB})
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()
+        self.size_dict = {}
+        self.current_bytes = 0
+        self.checkpoint_id = None
+
+        self.hit_num = 0
+        self.miss_num = 0
+        self.eviction_num = 0
+
+    def set_checkpoint(self, checkpoint_id):
+        """Clear cache if checkpoint changed"""
+        if checkpoint_id != self.checkpoint_id:
+            self.clear()
+            self.checkpoint_id = checkpoint_id
+
+    def clear(self):
+        self.cache.clear()
+        self.size_dict.clear()
+        self.current_bytes = 0
+
+    def make_key(self, text, problem):
+        return (normalize_text(text), problem, self.checkpoint_id)
+
+    def get(self, text, problem):
+        """Get cached prediction, None if missed"""
+        key = self.make_key(text, problem)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hit_num += 1
+            return self.cache[key]
+        self.miss_num += 1
+        return None
+
+    def put(self, text, problem, pred):
+        key = self.make_key(text, problem)
+        size = sys.getsizeof(key[0]) + sum(
+            [v.nbytes if isinstance(v, np.ndarray) else sys.getsizeof(v)
+             for v in pred.values()])
+        if size > self.max_bytes:
+            return
+
+        if key in self.cache:
+            self.current_bytes -= self.size_dict[key]
+        self.cache[key] = pred
+        self.cache.move_to_end(key)
+        self.size_dict[key] = size
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            evict_key, _ = self.cache.popitem(last=False)
+            self.current_bytes -= self.size_dict.pop(evict_key)
+            self.eviction_num += 1
+
+    def stats(self):
+        request_num = self.hit_num + self.miss_num
+        return {
+            'hit_num': self.hit_num,
+            'miss_num': self.miss_num,
+            'hit_rate': self.hit_num / request_num if request_num else 0.0,
+            'eviction_num': self.eviction_num,
+            'size': len(self.cache),
+            'bytes': self.current_bytes
+        }
@@ -0,0 +1,92 @@
+"""Break cold start of a predictor into stages
+
+    python -m src.startup_profile --problem NER --model_dir tmp/NER_ckpt
+
+Flags are parsed with argparse since tensorflow must not be imported
+before its import is timed.
+"""
+import argparse
+import collections
+import importlib
+import sys
+import time
+
+# modules the predict path should not import
+LAZY_MODULES = ['tensor2tensor', 'tqdm',
+                'sklearn', 'src.estimator', 'src.data_preprocessing']
+
+
+def time_imports(module_list):
+    import_time = collections.OrderedDict()
+    for module in module_list:
+        start_time = time.time()
+        importlib.import_module(module)
+        import_time['import %s' % module] = time.time() - start_time
+    return import_time
+
+
+def format_report(stage_time):
+    total = sum(stage_time.values())
+    lines = ['%-40s %8.3fs %6.1f%%' % (stage, t, 100 * t / total if total else 0)
+             for stage, t in stage_time.items()]
+    lines.append('%-40s %8.3fs' % ('total', total))
+    return '\n'.join(lines)
+
+
+def profile_startup(problem, model_dir=None, gpu=1):
+    """Build a warm predictor of problem and time each startup stage,
+    then check that the estimator of a non-warm predictor builds
+
+    Arguments:
+        problem {str} -- problem to predict
+
+    Keyword Arguments:
+        model_dir {str} -- model dir (default: {None})
+        gpu {int} -- number of gpu, 0 for cpu (default: {1})
+
+    Returns:
+        tuple -- OrderedDict of stage: seconds, list of lazy modules
+            that got imported anyway
+    """
+    stage_time = time_imports(
+        ['numpy', 'tensorflow', 'bert.modeling', 'src.estimator_wrapper'])
+
+    from .params import Params
+    from .estimator_wrapper import get_predictor
+
+    start_time = time.time()
+    params = Params()
+    stage_time['Params()'] = time.time() - start_time
+
+    predictor, _ = get_predictor(params, problem, model_dir=model_dir, gpu=gpu)
+    stage_time.update(predictor.startup_time)
+    predictor.close()
+    loaded_lazy_modules = [m for m in LAZY_MODULES if m in sys.modules]
+
+    # lazy modules must still work where they are needed,
+    # build the estimator of the non-warm path once
+    start_time = time.time()
+    cold_predictor, _ = get_predictor(
+        params, problem, model_dir=model_dir, gpu=gpu, warm_session=False)
+    cold_predictor.estimator
+    stage_time['build estimator (warm_session=False)'] = time.time() - start_time
+    return stage_time, loaded_lazy_modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--problem', default='NER')
+    parser.add_argument('--model_dir', default=None)
+    parser.add_argument('--gpu', type=int, default=1)
+    args = parser.parse_args()
+
+    stage_time, loaded_lazy_modules = profile_startup(
+        args.problem, args.model_dir, args.gpu)
+    print(format_report(stage_time))
+    if loaded_lazy_modules:
+        print('Imported but not needed for prediction: %s' %
+              ', '.join(loaded_lazy_modules))
+
+
+if __name__ == '__main__':
+    main()
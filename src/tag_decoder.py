@@ -0,0 +1,220 @@
+import numpy as np
+
+
+def pad_sequences(seq_list, pad_value=0):
+    """Pad list of 1d sequences to a 2d array
+
+    Arguments:
+        seq_list {list} -- list of 1d array-like
+
+    Keyword Arguments:
+        pad_value {int} -- pad value (default: {0})
+
+    Returns:
+        tuple -- padded array [batch, max_len], valid mask [batch, max_len]
+    """
+    lengths = np.array([len(seq) for seq in seq_list])
+    max_len = lengths.max() if len(lengths) else 0
+    valid = np.arange(max_len)[np.newaxis, :] < lengths[:, np.newaxis]
+    padded = np.full((len(seq_list), max_len), pad_value, dtype=np.int64)
+    if valid.any():
+        padded[valid] = np.concatenate([np.asarray(seq) for seq in seq_list])
+    return padded, valid
+
+
+def extract_spans(is_begin, is_inside, type_ids):
+    """Extract BIO entity spans with array operations
+
+    Same rule as get_ner_BIO: an entity starts at a B tag, and
+    continues over following I tags of the same type. I tags that
+    do not follow an entity are ignored.
+
+    Arguments:
+        is_begin {np.array} -- bool, [batch, seq], whether tag is B
+        is_inside {np.array} -- bool, [batch, seq], whether tag is I
+        type_ids {np.array} -- int, [batch, seq], entity type of tag
+
+    Returns:
+        np.array -- int, [num_spans, 4], (batch index, start, end, type id),
+            end is exclusive
+    """
+    batch_size, seq_len = is_begin.shape
+    if seq_len == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    # position t continues t-1 if it's I of the same type
+    # and t-1 is B or I
+    link = np.zeros_like(is_begin)
+    link[:, 1:] = is_inside[:, 1:] & \
+        (type_ids[:, 1:] == type_ids[:, :-1]) & \
+        (is_begin[:, :-1] | is_inside[:, :-1])
+
+    # flatten, a span never crosses a row since link[:, 0] is False
+    flat_break = np.flatnonzero(~link.reshape(-1))
+    begin_ind = np.flatnonzero(is_begin.reshape(-1))
+
+    # end is the next break after begin
+    next_break = np.searchsorted(flat_break, begin_ind, side='right')
+    end_ind = np.append(flat_break, batch_size * seq_len)[next_break]
+
+    batch_ind = begin_ind // seq_len
+    spans = np.stack([batch_ind,
+                      begin_ind - batch_ind * seq_len,
+                      end_ind - batch_ind * seq_len,
+                      type_ids.reshape(-1)[begin_ind]], axis=1)
+    return spans.astype(np.int64)
+
+
+def extract_bmes_spans(is_begin, is_middle, is_end, is_single, type_ids):
+    """Extract BMES entity spans with array operations
+
+    An entity is a B tag, followed by M tags and an E tag of the same
+    type, or a single S tag. Incomplete entities are ignored.
+
+    Arguments:
+        is_begin {np.array} -- bool, [batch, seq], whether tag is B
+        is_middle {np.array} -- bool, [batch, seq], whether tag is M
+        is_end {np.array} -- bool, [batch, seq], whether tag is E
+        is_single {np.array} -- bool, [batch, seq], whether tag is S
+        type_ids {np.array} -- int, [batch, seq], entity type of tag
+
+    Returns:
+        np.array -- int, [num_spans, 4], (batch index, start, end, type id),
+            end is exclusive
+    """
+    batch_size, seq_len = is_begin.shape
+    if seq_len == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    # position t continues t-1 if it's M or E of the same type
+    # and t-1 is B or M
+    link = np.zeros_like(is_begin)
+    link[:, 1:] = (is_middle[:, 1:] | is_end[:, 1:]) & \
+        (type_ids[:, 1:] == type_ids[:, :-1]) & \
+        (is_begin[:, :-1] | is_middle[:, :-1])
+
+    flat_break = np.flatnonzero(~link.reshape(-1))
+    begin_ind = np.flatnonzero(is_begin.reshape(-1))
+    next_break = np.searchsorted(flat_break, begin_ind, side='right')
+    end_ind = np.append(flat_break, batch_size * seq_len)[next_break]
+
+    # complete only if the run ends with E
+    complete = is_end.reshape(-1)[end_ind - 1]
+    single_ind = np.flatnonzero(is_single.reshape(-1))
+    begin_ind = np.concatenate([begin_ind[complete], single_ind])
+    end_ind = np.concatenate([end_ind[complete], single_ind + 1])
+    order = np.argsort(begin_ind, kind='stable')
+    begin_ind, end_ind = begin_ind[order], end_ind[order]
+
+    batch_ind = begin_ind // seq_len
+    spans = np.stack([batch_ind,
+                      begin_ind - batch_ind * seq_len,
+                      end_ind - batch_ind * seq_len,
+                      type_ids.reshape(-1)[begin_ind]], axis=1)
+    return spans.astype(np.int64)
+
+
+class TagDecoder():
+    """Decode a batch of tag ids with numpy operations
+
+    Decode tables of labels and tokens are built once.
+
+    Arguments:
+        label_encoder {LabelEncoder} -- label encoder of problem
+        tokenizer {FullTokenizer} -- tokenizer
+    """
+
+    def __init__(self, label_encoder, tokenizer):
+        decode_dict = label_encoder.decode_dict
+        self.label_table = np.array(
+            [decode_dict.get(i, '[PAD]')
+             for i in range(max(decode_dict) + 1)], dtype=object)
+
+        self.token_table = np.array(
+            [tokenizer.inv_vocab[i] for i in range(len(tokenizer.inv_vocab))],
+            dtype=object)
+        self.special_ids = np.array(tokenizer.convert_tokens_to_ids(
+            ['[PAD]', '[CLS]', '[SEP]']))
+
+        # BIO tables, label 'B-PER' -> begin, type 'PER'
+        label_list = [str(l).upper() for l in self.label_table]
+        self.type_list = sorted(set(
+            [l[2:] for l in label_list if l[:2] in ['B-', 'I-']]))
+        type_ind = {t: i for i, t in enumerate(self.type_list)}
+        self.is_begin_table = np.array(
+            [l.startswith('B-') for l in label_list])
+        self.is_inside_table = np.array(
+            [l.startswith('I-') for l in label_list])
+        self.type_table = np.array(
+            [type_ind.get(l[2:], -1) for l in label_list])
+
+    def tokens_and_labels(self, input_ids_list, pred_list):
+        """Remove special tokens, decode ids to tokens and labels
+
+        Arguments:
+            input_ids_list {list} -- list of input ids of each doc
+            pred_list {list} -- list of tag ids of each doc,
+                same length as input ids
+
+        Returns:
+            tuple -- tokens [batch, seq], tag ids [batch, seq],
+                keep mask [batch, seq], padded with special tokens removed
+        """
+        input_ids, valid = pad_sequences(input_ids_list)
+        tag_ids, _ = pad_sequences(
+            [p[:len(ids)] for ids, p in zip(input_ids_list, pred_list)])
+        keep = valid & ~np.isin(input_ids, self.special_ids)
+
+        # move kept tokens to the front of each row
+        order = np.argsort(~keep, axis=1, kind='stable')
+        input_ids = np.take_along_axis(input_ids, order, axis=1)
+        tag_ids = np.take_along_axis(tag_ids, order, axis=1)
+        keep = np.take_along_axis(keep, order, axis=1)
+        return self.token_table[input_ids], tag_ids, keep
+
+    def decode_ner(self, input_ids_list, pred_list):
+        """Decode to list of (token, label) of each doc"""
+        tokens, tag_ids, keep = self.tokens_and_labels(
+            input_ids_list, pred_list)
+        labels = self.label_table[tag_ids]
+        lengths = keep.sum(axis=1)
+        return [list(zip(tokens[i, :l], labels[i, :l]))
+                for i, l in enumerate(lengths)]
+
+    def decode_cws(self, input_ids_list, pred_list):
+        """Decode bmes tags to segmented string of each doc"""
+        tokens, tag_ids, keep = self.tokens_and_labels(
+            input_ids_list, pred_list)
+        labels = self.label_table[tag_ids]
+        word_end = np.isin(labels, ['s', 'e']) & keep
+        tokens = np.where(word_end, tokens + ' ', tokens)
+        tokens = np.where(keep, tokens, '')
+        return [''.join(row) for row in tokens]
+
+    def decode_cls(self, input_ids_list, pred_list):
+        """Decode cls probs to label of each doc"""
+        return self.label_table[np.argmax(np.stack(pred_list), axis=-1)].tolist()
+
+    def decode_entities(self, input_ids_list, pred_list):
+        """Decode BIO tags to entities of each doc
+
+        Returns:
+            list -- list of entity dict of each doc,
+                keys: type, start, end, text. end is exclusive
+        """
+        tokens, tag_ids, keep = self.tokens_and_labels(
+            input_ids_list, pred_list)
+        spans = extract_spans(
+            self.is_begin_table[tag_ids] & keep,
+            self.is_inside_table[tag_ids] & keep,
+            self.type_table[tag_ids])
+
+        result_list = [[] for _ in input_ids_list]
+        for batch_ind, start, end, type_id in spans.tolist():
+            result_list[batch_ind].append({
+                'type': self.type_list[type_id],
+                'start': start,
+                'end': end,
+                'text': ''.join(tokens[batch_ind, start:end])
+            })
+        return result_list
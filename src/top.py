@@ -1,9 +1,5 @@
 import tensorflow as tf
 
-from tensor2tensor.utils import metrics
-
-from .t2t_utils import get_t2t_metric_op
-
 from bert import modeling
 
 
@@ -110,6 +106,12 @@ def seq_tag(model, features, hidden_feature, mode, problem_name):
         seq_loss = tf.reduce_mean(-log_likelihood)
 
         def metric_fn(label_ids, logits):
+            # tensor2tensor and metrics are only needed in eval,
+            # import them here to keep them out of prediction startup
+            from tensor2tensor.utils import metrics
+            from .t2t_utils import get_t2t_metric_op
+            from .metrics import entity_metric_ops, get_label_list
+
             predictions = tf.argmax(logits, axis=-1, output_type=tf.int32)
             prob = tf.nn.softmax(logits)
             accuracy = tf.metrics.accuracy(
@@ -122,14 +124,25 @@ def seq_tag(model, features, hidden_feature, mode, problem_name):
             f1_score = tf.contrib.metrics.f1_score(
                 one_hot_labels, prob, weights=features['input_mask'])
 
-            return {
+            metric_dict = {
                 "Accuracy": accuracy,
                 'Accuracy Per Sequence': acc_per_seq,
                 'F1 Score': f1_score
             }
 
+            # entity level metrics of crf decoded tags
+            viterbi_sequence, _ = tf.contrib.crf.crf_decode(
+                logits, crf_transition_param, seq_length)
+            metric_dict.update(entity_metric_ops(
+                label_ids, viterbi_sequence, features['input_mask'],
+                get_label_list(problem_name, model.config)))
+            return metric_dict
+
         eval_metrics = (metric_fn(seq_labels, logits), seq_loss)
         return eval_metrics
+    elif model.config.host_crf_decode:
+        # decoded by ViterbiDecoder on host
+        return logits
     else:
         viterbi_sequence, viterbi_score = tf.contrib.crf.crf_decode(
             logits, crf_transition_param, seq_length)
@@ -185,6 +198,33 @@ def mask_lm_top(model, features, hidden_feature, mode, problem_name):
             shape=[model.config.vocab_size],
             initializer=tf.zeros_initializer())
 
+        label_ids = tf.reshape(label_ids, [-1])
+        label_weights = tf.reshape(label_weights, [-1])
+
+        # sampled softmax avoids the full [num_predictions, vocab_size]
+        # logits while training
+        if mode == tf.estimator.ModeKeys.TRAIN and model.config.mask_lm_num_sampled:
+            sampled_labels = tf.expand_dims(tf.cast(label_ids, tf.int64), -1)
+            # the default log uniform sampler assumes ids sorted by
+            # frequency, bert vocab is not, sample uniformly instead
+            sampled_values = tf.nn.uniform_candidate_sampler(
+                true_classes=sampled_labels,
+                num_true=1,
+                num_sampled=model.config.mask_lm_num_sampled,
+                unique=True,
+                range_max=model.config.vocab_size)
+            per_example_loss = tf.nn.sampled_softmax_loss(
+                weights=output_weights,
+                biases=output_bias,
+                labels=sampled_labels,
+                inputs=input_tensor,
+                num_sampled=model.config.mask_lm_num_sampled,
+                num_classes=model.config.vocab_size,
+                sampled_values=sampled_values)
+            numerator = tf.reduce_sum(label_weights * per_example_loss)
+            denominator = tf.reduce_sum(label_weights) + 1e-5
+            return numerator / denominator
+
         logits = tf.matmul(input_tensor, output_weights, transpose_b=True)
         logits = tf.nn.bias_add(logits, output_bias)
         log_probs = tf.nn.log_softmax(logits, axis=-1)
@@ -193,19 +233,15 @@ def mask_lm_top(model, features, hidden_feature, mode, problem_name):
             return log_probs
 
         else:
-
-            label_ids = tf.reshape(label_ids, [-1])
-            label_weights = tf.reshape(label_weights, [-1])
-
-            one_hot_labels = tf.one_hot(
-                label_ids, depth=model.config.vocab_size, dtype=tf.float32)
-
             # The `positions` tensor might be zero-padded (if the sequence is too
             # short to have the maximum number of predictions). The `label_weights`
             # tensor has a value of 1.0 for every real prediction and 0.0 for the
             # padding predictions.
-            per_example_loss = - \
-                tf.reduce_sum(log_probs * one_hot_labels, axis=[-1])
+            # gather the log prob of labels instead of multiplying
+            # with a dense one hot of vocab_size
+            label_index = tf.stack(
+                [tf.range(tf.shape(label_ids)[0]), label_ids], axis=-1)
+            per_example_loss = -tf.gather_nd(log_probs, label_index)
             numerator = tf.reduce_sum(label_weights * per_example_loss)
             denominator = tf.reduce_sum(label_weights) + 1e-5
             loss = numerator / denominator
@@ -1,12 +1,13 @@
 import pickle
 import os
+import json
 import unicodedata
 import random
 import collections
+from glob import glob
 
 
 import numpy as np
-from sklearn.base import BaseEstimator, TransformerMixin
 import tensorflow as tf
 
 
@@ -14,7 +15,10 @@ from bert.tokenization import (_is_control,
                                printable_text)
 
 
-class LabelEncoder(BaseEstimator, TransformerMixin):
+class LabelEncoder():
+    """Encode labels to ids, same interface as sklearn transformers,
+    without importing sklearn on the predict path
+    """
 
     def fit(self, y, zero_class=None):
         """Fit label encoder
@@ -134,6 +138,98 @@ def get_or_make_label_encoder(problem, mode, label_list=None, zero_class='O'):
     return label_encoder
 
 
+def write_feature_cache(feature_iter, cache_dir, shard_size, dtype='float32'):
+    """Write extracted features to npy shards
+
+    Each key of a feature dict is stored in its own shard file
+    <key>_<shard index>.npy, float features are cast to dtype as
+    they are added to the shard.
+
+    Arguments:
+        feature_iter {iterable} -- iterable of feature dict of one example
+        cache_dir {str} -- dir to write shards
+        shard_size {int} -- number of examples per shard
+
+    Keyword Arguments:
+        dtype {str} -- dtype of float features (default: {'float32'})
+
+    Returns:
+        int -- number of examples written
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    def _write_shard(shard, shard_ind):
+        for key, value_list in shard.items():
+            value = np.stack(value_list)
+            np.save(os.path.join(cache_dir, '%s_%05d.npy' %
+                                 (key, shard_ind)), value)
+
+    shard = collections.defaultdict(list)
+    shard_ind = 0
+    example_num = 0
+    for feature in feature_iter:
+        for key, value in feature.items():
+            value = np.asarray(value)
+            if np.issubdtype(value.dtype, np.floating):
+                value = value.astype(dtype)
+            shard[key].append(value)
+        example_num += 1
+        if example_num % shard_size == 0:
+            _write_shard(shard, shard_ind)
+            shard = collections.defaultdict(list)
+            shard_ind += 1
+    if shard:
+        _write_shard(shard, shard_ind)
+    return example_num
+
+
+def read_feature_cache(cache_dir):
+    """Read features written by write_feature_cache, one example at a time
+
+    Shards are memory-mapped, so only the current examples are in memory.
+
+    Arguments:
+        cache_dir {str} -- dir of shards
+
+    Yields:
+        dict -- feature dict of one example
+    """
+    shard_ind = 0
+    while True:
+        shard_files = glob(os.path.join(
+            cache_dir, '*_%05d.npy' % shard_ind))
+        if not shard_files:
+            break
+        shard = {}
+        for shard_file in shard_files:
+            key = os.path.basename(shard_file)[:-len('_%05d.npy' % shard_ind)]
+            shard[key] = np.load(shard_file, mmap_mode='r')
+        example_num = len(next(iter(shard.values())))
+        for example_ind in range(example_num):
+            yield {key: value[example_ind] for key, value in shard.items()}
+        shard_ind += 1
+
+
+def write_label_encoder_json(problem):
+    """Write decode table of problem's label encoder as json
+    next to the pickled one, so it can be read without this code
+
+    Arguments:
+        problem {str} -- problem name
+
+    Returns:
+        str -- json path
+    """
+    label_encoder = get_or_make_label_encoder(problem, 'predict')
+    json_path = os.path.join(
+        'tmp', problem+'_ckpt', '%s_label_encoder.json' % problem)
+    with open(json_path, 'w', encoding='utf8') as f:
+        json.dump({str(k): v for k, v in label_encoder.decode_dict.items()},
+                  f, ensure_ascii=False)
+    return json_path
+
+
 def get_dirty_text_ind(text):
     """Performs invalid character removal and whitespace cleanup on text."""
 
@@ -399,37 +495,205 @@ def create_single_problem_generator(problem,
         }
 
 
+def get_file_fingerprint(file_list):
+    """Path, size and modified time of files, to tell whether
+    data derived from them is stale
+
+    Returns:
+        list -- [path, size, mtime] of each file, sorted by path
+    """
+    return [[path, os.path.getsize(path), os.path.getmtime(path)]
+            for path in sorted(file_list)]
+
+
+class DocumentStore():
+    """Memory-mapped token store of tokenized documents
+
+    Token ids of all sentences are stored in one flat file, with
+    a sentence offset index and a document offset index, so that
+    a document can be fetched by index without keeping the
+    corpus in memory.
+
+    It behaves like the list of list of tokens that
+    create_instances_from_document expects:
+        store[document_index][sentence_index] -> list of tokens
+
+    Files:
+        token_ids.bin: int32, token ids of all sentences
+        sentence_offsets.bin: int64, [num_sentences + 1]
+        document_offsets.bin: int64, [num_documents + 1], in sentences
+        fingerprint.json: fingerprint of source data, see get_file_fingerprint
+    """
+
+    def __init__(self, store_dir, tokenizer):
+        self.store_dir = store_dir
+        self.tokenizer = tokenizer
+        self.token_ids = self._load('token_ids.bin', np.int32)
+        self.sentence_offsets = self._load('sentence_offsets.bin', np.int64)
+        self.document_offsets = self._load('document_offsets.bin', np.int64)
+        self.order = np.arange(len(self.document_offsets) - 1)
+
+    def _load(self, file_name, dtype):
+        path = os.path.join(self.store_dir, file_name)
+        # np.memmap cannot map an empty file
+        if os.path.getsize(path) == 0:
+            return np.zeros([0], dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    @staticmethod
+    def exists(store_dir, fingerprint=None):
+        """Whether a complete store exists in store_dir, and
+        was built from source data with the same fingerprint
+        """
+        if not os.path.exists(os.path.join(store_dir, 'document_offsets.bin')):
+            return False
+        if fingerprint is None:
+            return True
+        fingerprint_path = os.path.join(store_dir, 'fingerprint.json')
+        if not os.path.exists(fingerprint_path):
+            return False
+        with open(fingerprint_path, 'r', encoding='utf8') as f:
+            # compare after json round trip, tuples become lists
+            return json.load(f) == json.loads(json.dumps(fingerprint))
+
+    @classmethod
+    def build(cls, store_dir, inputs_list, tokenizer, fingerprint=None):
+        """Tokenize documents and write them to store_dir
+
+        Documents are written one by one, so inputs_list can be
+        a generator and the corpus is never held in memory.
+
+        Arguments:
+            store_dir {str} -- dir to write to
+            inputs_list {iterable} -- iterable of documents,
+                document is list of sentences, sentence is list of chars
+            tokenizer {FullTokenizer} -- tokenizer
+
+        Keyword Arguments:
+            fingerprint {list} -- fingerprint of source data,
+                see get_file_fingerprint (default: {None})
+
+        Returns:
+            DocumentStore -- store
+        """
+        create_path(os.path.dirname(store_dir))
+        create_path(store_dir)
+        # mark a stale store as incomplete before overwriting it
+        for file_name in ['document_offsets.bin', 'fingerprint.json']:
+            if os.path.exists(os.path.join(store_dir, file_name)):
+                os.remove(os.path.join(store_dir, file_name))
+        sentence_offset = 0
+        token_offset = 0
+        with open(os.path.join(store_dir, 'token_ids.bin'), 'wb') as token_f, \
+                open(os.path.join(store_dir, 'sentence_offsets.bin'), 'wb') as sentence_f, \
+                open(os.path.join(store_dir, 'document_offsets.bin.tmp'), 'wb') as document_f:
+            np.array([0], dtype=np.int64).tofile(sentence_f)
+            np.array([0], dtype=np.int64).tofile(document_f)
+            for document in inputs_list:
+                sentence_lengths = []
+                for sentence in document:
+                    tokens = tokenizer.tokenize('\t'.join(sentence))
+                    if not tokens:
+                        continue
+                    np.array(tokenizer.convert_tokens_to_ids(tokens),
+                             dtype=np.int32).tofile(token_f)
+                    sentence_lengths.append(len(tokens))
+
+                # skip empty documents
+                if not sentence_lengths:
+                    continue
+                ends = token_offset + np.cumsum(sentence_lengths)
+                ends.astype(np.int64).tofile(sentence_f)
+                token_offset = int(ends[-1])
+                sentence_offset += len(sentence_lengths)
+                np.array([sentence_offset], dtype=np.int64).tofile(document_f)
+
+        if fingerprint is not None:
+            with open(os.path.join(store_dir, 'fingerprint.json'), 'w', encoding='utf8') as f:
+                json.dump(fingerprint, f)
+
+        # document index is written last, so a partial build is not
+        # mistaken for a complete store
+        os.rename(os.path.join(store_dir, 'document_offsets.bin.tmp'),
+                  os.path.join(store_dir, 'document_offsets.bin'))
+        return cls(store_dir, tokenizer)
+
+    def shuffle(self, rng):
+        order = self.order.tolist()
+        rng.shuffle(order)
+        self.order = np.array(order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, document_index):
+        document_index = self.order[document_index]
+        sentence_start = self.document_offsets[document_index]
+        sentence_end = self.document_offsets[document_index + 1]
+        offsets = self.sentence_offsets[sentence_start:sentence_end + 1]
+        return [self.tokenizer.convert_ids_to_tokens(
+            self.token_ids[start:end].tolist())
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
 def create_pretraining_generator(problem,
                                  inputs_list,
                                  target_list,
                                  label_encoder,
                                  params,
-                                 tokenizer
+                                 tokenizer,
+                                 mode='train',
+                                 source_files=None
                                  ):
     """Slight modification of original code
 
+    If params.document_store is True, documents are tokenized once
+    into a memory-mapped DocumentStore under tmp/<problem>_ckpt, and
+    read from there afterwards. In this case inputs_list can be any
+    iterable of documents, e.g. a generator, and will not be consumed
+    if the store exists. The store is rebuilt if source_files or the
+    vocab file changed since it was built.
+
     Raises:
         ValueError -- Input format not right
     """
 
-    if not isinstance(inputs_list[0][0], list):
-        raise ValueError('inputs is expected to be list of list of list.')
+    rng = random.Random()
+    if params.document_store:
+        store_dir = os.path.join(
+            'tmp', problem+'_ckpt', '%s_documents' % mode)
+        fingerprint = get_file_fingerprint(
+            list(source_files or []) + [params.vocab_file])
+        if DocumentStore.exists(store_dir, fingerprint):
+            all_documents = DocumentStore(store_dir, tokenizer)
+        else:
+            all_documents = DocumentStore.build(
+                store_dir, inputs_list, tokenizer, fingerprint)
+        all_documents.shuffle(rng)
+    else:
+        if not isinstance(inputs_list[0][0], list):
+            raise ValueError('inputs is expected to be list of list of list.')
 
-    all_documents = []
-    for document in inputs_list:
-        all_documents.append([])
-        for sentence in document:
-            all_documents[-1].append(tokenizer.tokenize('\t'.join(sentence)))
+        all_documents = []
+        for document in inputs_list:
+            all_documents.append([])
+            for sentence in document:
+                all_documents[-1].append(
+                    tokenizer.tokenize('\t'.join(sentence)))
 
-    all_documents = [d for d in all_documents if d]
-    rng = random.Random()
-    rng.shuffle(all_documents)
+        all_documents = [d for d in all_documents if d]
+        rng.shuffle(all_documents)
 
     vocab_words = list(tokenizer.vocab.keys())
     instances = []
 
+    # with dynamic masking, masks are drawn in the input pipeline,
+    # so there is no need to duplicate the data
+    dynamic_masking = params.dynamic_masking
+    dupe_factor = 1 if dynamic_masking else params.dupe_factor
+
     print_count = 0
-    for _ in range(params.dupe_factor):
+    for _ in range(dupe_factor):
         for document_index in range(len(all_documents)):
             instances = create_instances_from_document(
                 all_documents,
@@ -438,31 +702,36 @@ def create_pretraining_generator(problem,
                 params.short_seq_prob,
                 params.masked_lm_prob,
                 params.max_predictions_per_seq,
-                vocab_words, rng)
+                vocab_words, rng,
+                dynamic_masking=dynamic_masking)
             for instance in instances:
                 tokens = instance.tokens
                 segment_ids = list(instance.segment_ids)
 
                 input_mask, tokens, segment_ids, _ = create_mask_and_padding(
                     tokens, segment_ids, None, params.max_seq_len)
-                masked_lm_positions = list(instance.masked_lm_positions)
-                masked_lm_weights, masked_lm_labels, masked_lm_positions, _ = create_mask_and_padding(
-                    instance.masked_lm_labels, masked_lm_positions, None, params.max_predictions_per_seq)
                 input_ids = tokenizer.convert_tokens_to_ids(tokens)
-                masked_lm_ids = tokenizer.convert_tokens_to_ids(
-                    masked_lm_labels)
                 next_sentence_label = 1 if instance.is_random_next else 0
 
                 yield_dict = {
                     "input_ids": input_ids,
                     "input_mask": input_mask,
                     "segment_ids": segment_ids,
-                    "masked_lm_positions": masked_lm_positions,
-                    "masked_lm_ids": masked_lm_ids,
-                    "masked_lm_weights": masked_lm_weights,
                     "next_sentence_label_ids": next_sentence_label
                 }
 
+                if not dynamic_masking:
+                    masked_lm_positions = list(instance.masked_lm_positions)
+                    masked_lm_weights, masked_lm_labels, masked_lm_positions, _ = create_mask_and_padding(
+                        instance.masked_lm_labels, masked_lm_positions, None, params.max_predictions_per_seq)
+                    masked_lm_ids = tokenizer.convert_tokens_to_ids(
+                        masked_lm_labels)
+                    yield_dict.update({
+                        "masked_lm_positions": masked_lm_positions,
+                        "masked_lm_ids": masked_lm_ids,
+                        "masked_lm_weights": masked_lm_weights
+                    })
+
                 if print_count < 3:
                     tf.logging.debug('%s : %s' %
                                      ('tokens', ' '.join([str(x) for x in tokens])))
@@ -475,7 +744,7 @@ def create_pretraining_generator(problem,
                 yield yield_dict
 
 
-def create_generator(params, mode, epoch):
+def create_generator(params, mode, epoch, repeat=None):
     """Function to create iterator for multiple problem
 
     This function dose the following things:
@@ -498,7 +767,14 @@ def create_generator(params, mode, epoch):
         params {Params} -- params
         mode {mode} -- mode
         epoch {int} -- epochs to run
+
+    Keyword Arguments:
+        repeat {bool} -- whether to re-init exhausted generators,
+            default to True if mode is train (default: {None})
     """
+    if repeat is None:
+        repeat = mode == 'train'
+
     # example
     # problem_list: ['NER', 'CWS', 'WeiboNER', 'WeiboSegment']
     # problem_chunk: [['NER'], ['CWS'], ['WeiboNER', 'WeiboSegment']]
@@ -553,7 +829,7 @@ def create_generator(params, mode, epoch):
             try:
                 instance = next(gen_dict[problem])
             except StopIteration:
-                if mode == 'train':
+                if repeat:
                     gen_dict[problem] = params.read_data_fn[problem](
                         params, mode)
                     instance = next(gen_dict[problem])
@@ -587,8 +863,13 @@ def create_generator(params, mode, epoch):
 
 def create_instances_from_document(
         all_documents, document_index, max_seq_length, short_seq_prob,
-        masked_lm_prob, max_predictions_per_seq, vocab_words, rng):
-    """Creates `TrainingInstance`s for a single document."""
+        masked_lm_prob, max_predictions_per_seq, vocab_words, rng,
+        dynamic_masking=False):
+    """Creates `TrainingInstance`s for a single document.
+
+    If dynamic_masking, tokens are left unmasked and masked lm
+    predictions are left empty.
+    """
     document = all_documents[document_index]
 
     # Account for [CLS], [SEP], [SEP]
@@ -689,9 +970,12 @@ def create_instances_from_document(
                 tokens.append("[SEP]")
                 segment_ids.append(1)
 
-                (tokens, masked_lm_positions,
-                 masked_lm_labels) = create_masked_lm_predictions(
-                     tokens, masked_lm_prob, max_predictions_per_seq, vocab_words, rng)
+                if dynamic_masking:
+                    masked_lm_positions, masked_lm_labels = [], []
+                else:
+                    (tokens, masked_lm_positions,
+                     masked_lm_labels) = create_masked_lm_predictions(
+                         tokens, masked_lm_prob, max_predictions_per_seq, vocab_words, rng)
                 instance = TrainingInstance(
                     tokens=tokens,
                     segment_ids=segment_ids,
@@ -767,3 +1051,94 @@ def create_masked_lm_predictions(tokens, masked_lm_prob,
         masked_lm_labels.append(p.label)
 
     return (output_tokens, masked_lm_positions, masked_lm_labels)
+
+
+def create_dynamic_masked_lm_predictions(features,
+                                         masked_lm_prob,
+                                         max_predictions_per_seq,
+                                         vocab_size,
+                                         mask_id,
+                                         special_ids):
+    """Tensor version of create_masked_lm_predictions.
+
+    Works on a batch of unmasked features, so that a new mask
+    is drawn every time an example is seen.
+
+    Arguments:
+        features {dict} -- batched feature dict,
+            keys: input_ids, input_mask, segment_ids
+        masked_lm_prob {float} -- masked lm prob
+        max_predictions_per_seq {int} -- max predictions per seq
+        vocab_size {int} -- vocab size
+        mask_id {int} -- id of [MASK]
+        special_ids {list} -- ids that should never be masked, e.g. [CLS], [SEP]
+
+    Returns:
+        dict -- features with masked input_ids and
+            masked_lm_positions, masked_lm_ids, masked_lm_weights
+    """
+    input_ids = features['input_ids']
+    input_mask = features['input_mask']
+    input_shape = tf.shape(input_ids)
+    batch_size, seq_length = input_shape[0], input_shape[1]
+
+    cand_mask = tf.cast(input_mask, tf.bool)
+    for special_id in special_ids:
+        cand_mask = tf.logical_and(
+            cand_mask, tf.not_equal(input_ids, special_id))
+
+    # num_to_predict = min(max_predictions_per_seq,
+    #                      max(1, round(len(tokens) * masked_lm_prob)))
+    num_tokens = tf.cast(tf.reduce_sum(input_mask, axis=-1), tf.float32)
+    num_to_predict = tf.cast(tf.round(num_tokens * masked_lm_prob), tf.int32)
+    num_to_predict = tf.clip_by_value(
+        num_to_predict, 1, max_predictions_per_seq)
+
+    # random shuffle of candidates: take top k of random scores,
+    # non-candidates always rank last
+    scores = tf.random_uniform(input_shape)
+    scores = tf.where(cand_mask, scores, -tf.ones_like(scores))
+    top_scores, positions = tf.nn.top_k(scores, k=max_predictions_per_seq)
+    rank = tf.range(max_predictions_per_seq)[tf.newaxis, :]
+    is_masked = tf.logical_and(
+        top_scores >= 0, rank < num_to_predict[:, tf.newaxis])
+
+    # sort positions ascending, padding goes to the end
+    positions = tf.where(
+        is_masked, positions, tf.fill(tf.shape(positions), seq_length))
+    positions = -tf.nn.top_k(-positions, k=max_predictions_per_seq)[0]
+    is_masked = positions < seq_length
+    positions = tf.where(is_masked, positions, tf.zeros_like(positions))
+    masked_lm_weights = tf.cast(is_masked, tf.float32)
+
+    flat_offsets = tf.range(batch_size)[:, tf.newaxis] * seq_length
+    flat_input_ids = tf.reshape(input_ids, [-1])
+    masked_lm_ids = tf.gather(flat_input_ids, positions + flat_offsets)
+    masked_lm_ids = masked_lm_ids * tf.cast(is_masked, masked_lm_ids.dtype)
+
+    # 80% of the time, replace with [MASK]
+    # 10% of the time, keep original
+    # 10% of the time, replace with random word
+    prediction_shape = tf.shape(positions)
+    replace_prob = tf.random_uniform(prediction_shape)
+    random_ids = tf.random_uniform(
+        prediction_shape, maxval=vocab_size, dtype=input_ids.dtype)
+    masked_tokens = tf.where(
+        replace_prob < 0.8,
+        tf.fill(prediction_shape, tf.cast(mask_id, input_ids.dtype)),
+        tf.where(replace_prob < 0.9, masked_lm_ids, random_ids))
+
+    # scatter masked tokens back to input_ids
+    position_one_hot = tf.one_hot(
+        positions, depth=seq_length, dtype=input_ids.dtype) * \
+        tf.cast(is_masked, input_ids.dtype)[:, :, tf.newaxis]
+    replace_mask = tf.reduce_sum(position_one_hot, axis=1) > 0
+    replace_ids = tf.reduce_sum(
+        position_one_hot * masked_tokens[:, :, tf.newaxis], axis=1)
+
+    features = dict(features)
+    features['input_ids'] = tf.where(replace_mask, replace_ids, input_ids)
+    features['masked_lm_positions'] = positions
+    features['masked_lm_ids'] = masked_lm_ids
+    features['masked_lm_weights'] = masked_lm_weights
+    return features
@@ -0,0 +1,246 @@
+import numpy as np
+
+# score of forbidden transitions, finite so that
+# sums of forbidden paths stay comparable
+FORBIDDEN_SCORE = -1e9
+
+
+def viterbi_decode(logits, transition, seq_length,
+                   start_score=None, end_score=None):
+    """Batched viterbi decoding, same as tf.contrib.crf.crf_decode
+    when start_score and end_score are None
+
+    Arguments:
+        logits {np.array} -- emission scores, [batch, seq, num_tags]
+        transition {np.array} -- transition scores, [num_tags, num_tags]
+        seq_length {np.array} -- length of each sequence, [batch]
+
+    Keyword Arguments:
+        start_score {np.array} -- score of the first tag, [num_tags] (default: {None})
+        end_score {np.array} -- score of the last tag, [num_tags] (default: {None})
+
+    Returns:
+        tuple -- int32 best tags [batch, seq], 0 after seq_length;
+            best scores [batch]
+    """
+    tags, scores = viterbi_decode_top_k(
+        logits, transition, seq_length, 1, start_score, end_score)
+    return tags[:, 0], scores[:, 0]
+
+
+def viterbi_decode_top_k(logits, transition, seq_length, k,
+                         start_score=None, end_score=None):
+    """Batched k best viterbi decoding
+
+    Every tag keeps its k best partial paths. Sequences shorter than
+    the batch keep their scores after seq_length, and their paths
+    point to themselves, so all sequences are traced back from the
+    last step.
+
+    Arguments:
+        logits {np.array} -- emission scores, [batch, seq, num_tags]
+        transition {np.array} -- transition scores, [num_tags, num_tags]
+        seq_length {np.array} -- length of each sequence, [batch]
+        k {int} -- number of best paths
+
+    Keyword Arguments:
+        start_score {np.array} -- score of the first tag, [num_tags] (default: {None})
+        end_score {np.array} -- score of the last tag, [num_tags] (default: {None})
+
+    Returns:
+        tuple -- int32 best tags [batch, k, seq], 0 after seq_length;
+            scores [batch, k], sorted in descending order. If there are
+            less than k paths, the rest have score -inf
+    """
+    logits = np.asarray(logits, dtype=np.float64)
+    seq_length = np.asarray(seq_length)
+    batch_size, max_len, num_tags = logits.shape
+    batch_ind = np.arange(batch_size)[:, np.newaxis]
+
+    # score of the k best paths ending with each tag, [batch, num_tags, k]
+    score = np.full((batch_size, num_tags, k), -np.inf)
+    score[:, :, 0] = logits[:, 0]
+    if start_score is not None:
+        score[:, :, 0] += start_score
+
+    # back pointers to (previous tag, previous path) as tag * k + path,
+    # [batch, seq, num_tags, k]
+    keep_pointer = np.arange(num_tags * k).reshape(num_tags, k)
+    backpointers = np.zeros((batch_size, max_len, num_tags, k), dtype=np.int64)
+    backpointers[:, 0] = keep_pointer
+    for t in range(1, max_len):
+        # [batch, from tag, path, to tag] -> [batch, from tag * path, to tag]
+        candidate = score[:, :, :, np.newaxis] + \
+            transition[np.newaxis, :, np.newaxis, :]
+        candidate = candidate.reshape(batch_size, num_tags * k, num_tags)
+
+        # k best of each to tag, [batch, k, to tag]
+        best_prev = np.argsort(-candidate, axis=1, kind='stable')[:, :k]
+        best_score = np.take_along_axis(candidate, best_prev, axis=1)
+        new_score = best_score.transpose(0, 2, 1) + logits[:, t, :, np.newaxis]
+        best_prev = best_prev.transpose(0, 2, 1)
+
+        # finished sequences keep their score and point to themselves
+        active = (t < seq_length)[:, np.newaxis, np.newaxis]
+        score = np.where(active, new_score, score)
+        backpointers[:, t] = np.where(active, best_prev, keep_pointer)
+
+    if end_score is not None:
+        score = score + end_score[np.newaxis, :, np.newaxis]
+
+    # k best of all paths
+    flat_score = score.reshape(batch_size, num_tags * k)
+    pointer = np.argsort(-flat_score, axis=1, kind='stable')[:, :k]
+    top_score = np.take_along_axis(flat_score, pointer, axis=1)
+
+    tags = np.zeros((batch_size, k, max_len), dtype=np.int32)
+    for t in range(max_len - 1, -1, -1):
+        tags[:, :, t] = pointer // k
+        pointer = backpointers[batch_ind, t, pointer // k, pointer % k]
+
+    tags[np.broadcast_to(
+        np.arange(max_len)[np.newaxis, np.newaxis, :] >=
+        seq_length[:, np.newaxis, np.newaxis], tags.shape)] = 0
+    return tags, top_score
+
+
+def parse_label(label):
+    """Split label into (tag, type), e.g. 'B-PER' -> ('B', 'PER'),
+    'b' -> ('B', ''). Labels that are not BIO/BMES, e.g. '[PAD]',
+    return None as tag
+    """
+    label = str(label)
+    if len(label) > 2 and label[1] == '-' and label[0].upper() in 'BIMES':
+        return label[0].upper(), label[2:]
+    if label.upper() in ['B', 'I', 'M', 'E', 'S', 'O']:
+        return label.upper(), ''
+    return None, ''
+
+
+def get_transition_constraints(label_list, scheme=None):
+    """Get which transitions are allowed by BIO or BMES scheme
+
+    Labels that are neither BIO nor BMES, e.g. [PAD] of [CLS] and [SEP],
+    are treated as sequence boundaries: anything may follow or precede
+    them as long as it may start or end a sequence.
+
+    Arguments:
+        label_list {list} -- label of each tag id
+
+    Keyword Arguments:
+        scheme {str} -- 'bio' or 'bmes', None to detect
+            from labels (default: {None})
+
+    Returns:
+        tuple -- allowed transition [num_tags, num_tags], allowed
+            start [num_tags], allowed end [num_tags], all bool
+    """
+    parsed = [parse_label(label) for label in label_list]
+    if scheme is None:
+        scheme = 'bmes' if any(
+            [tag in ['M', 'E', 'S'] for tag, _ in parsed]) else 'bio'
+
+    if scheme == 'bio':
+        def can_start(tag): return tag != 'I'
+
+        def can_end(tag): return True
+
+        def can_follow(prev, cur):
+            if cur[0] == 'I':
+                return prev[0] in ['B', 'I'] and prev[1] == cur[1]
+            return True
+    elif scheme == 'bmes':
+        def can_start(tag): return tag in ['B', 'S', 'O']
+
+        def can_end(tag): return tag in ['E', 'S', 'O']
+
+        def can_follow(prev, cur):
+            if cur[0] in ['M', 'E']:
+                return prev[0] in ['B', 'M'] and prev[1] == cur[1]
+            return can_end(prev[0])
+    else:
+        raise ValueError('Unknown scheme %s, should be bio or bmes' % scheme)
+
+    num_tags = len(label_list)
+    allowed = np.ones((num_tags, num_tags), dtype=bool)
+    for i, prev in enumerate(parsed):
+        for j, cur in enumerate(parsed):
+            if prev[0] is None and cur[0] is None:
+                continue
+            elif prev[0] is None:
+                allowed[i, j] = can_start(cur[0])
+            elif cur[0] is None:
+                allowed[i, j] = can_end(prev[0])
+            else:
+                allowed[i, j] = can_follow(prev, cur)
+
+    allowed_start = np.array(
+        [tag is None or can_start(tag) for tag, _ in parsed])
+    allowed_end = np.array(
+        [tag is None or can_end(tag) for tag, _ in parsed])
+    return allowed, allowed_start, allowed_end
+
+
+class ViterbiDecoder():
+    """Decode seq_tag logits with the learned crf_transition on host
+
+    Example:
+        decoder = ViterbiDecoder.from_checkpoint(
+            'tmp/NER_ckpt', 'NER', params, label_list=label_list)
+        tags = decoder.decode(logits, seq_length)
+        top_tags, top_scores = decoder.decode_top_k(logits, seq_length, k=5)
+
+    Arguments:
+        transition {np.array} -- transition scores, [num_tags, num_tags]
+
+    Keyword Arguments:
+        label_list {list} -- label of each tag id, needed if
+            constrained (default: {None})
+        constrained {bool} -- forbid transitions that are illegal
+            in scheme (default: {False})
+        scheme {str} -- 'bio' or 'bmes', None to detect from
+            label_list (default: {None})
+    """
+
+    def __init__(self, transition, label_list=None, constrained=False, scheme=None):
+        self.transition = np.asarray(transition, dtype=np.float64)
+        self.start_score = None
+        self.end_score = None
+
+        if constrained:
+            if label_list is None:
+                raise ValueError('label_list is needed if constrained')
+            allowed, allowed_start, allowed_end = get_transition_constraints(
+                label_list, scheme)
+            self.transition = np.where(
+                allowed, self.transition, FORBIDDEN_SCORE)
+            self.start_score = np.where(allowed_start, 0, FORBIDDEN_SCORE)
+            self.end_score = np.where(allowed_end, 0, FORBIDDEN_SCORE)
+
+    @classmethod
+    def from_checkpoint(cls, model_dir_or_checkpoint, problem, params, **kwargs):
+        """Read `<problem>_top/crf_transition`, respecting params.share_top,
+        from the latest checkpoint in model dir, or from a checkpoint path
+        """
+        import tensorflow as tf
+
+        checkpoint_path = tf.train.latest_checkpoint(model_dir_or_checkpoint)
+        if checkpoint_path is None:
+            checkpoint_path = model_dir_or_checkpoint
+        top_scope = '%s_top' % params.share_top.get(problem, problem)
+        transition = tf.train.load_checkpoint(
+            checkpoint_path).get_tensor(top_scope + '/crf_transition')
+        return cls(transition, **kwargs)
+
+    def decode(self, logits, seq_length):
+        """Best tags of each sequence, [batch, seq], 0 after seq_length"""
+        tags, _ = viterbi_decode(
+            logits, self.transition, seq_length,
+            self.start_score, self.end_score)
+        return tags
+
+    def decode_top_k(self, logits, seq_length, k):
+        """k best tags [batch, k, seq] and their scores [batch, k]"""
+        return viterbi_decode_top_k(
+            logits, self.transition, seq_length, k,
+            self.start_score, self.end_score)